@@ -342,27 +342,32 @@ async def upload_document(
     extracted_text = ""
     pages = 1
     try:
-        # Save to temp file for processing
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-            tmp_file.write(file_data)
-            tmp_path = tmp_file.name
+        if file_ext.lower() in DocumentProcessor.PLAIN_TEXT_EXTENSIONS:
+            # Текст декодируется из памяти, без временного файла
+            extracted_text = processor.load_text_bytes(file_data, file_ext)
+            pages = max(1, len(extracted_text) // 2000)
+        else:
+            # Save to temp file for processing
+            with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
+                tmp_file.write(file_data)
+                tmp_path = tmp_file.name
         
-        try:
-            extracted_text = processor.load_file(tmp_path)
-            # Calculate pages from extracted text or file
-            if file_ext.lower() == '.pdf':
-                # Try to get actual page count
-                try:
-                    import pdfplumber
-                    with pdfplumber.open(tmp_path) as pdf:
-                        pages = len(pdf.pages)
-                except:
-                    pages = max(1, file_size // 50000)
-            else:
-                # Estimate pages from text length
-                pages = max(1, len(extracted_text) // 2000)
-        finally:
-            os.unlink(tmp_path)
+            try:
+                extracted_text = processor.load_file(tmp_path)
+                # Calculate pages from extracted text or file
+                if file_ext.lower() == '.pdf':
+                    # Try to get actual page count
+                    try:
+                        import pdfplumber
+                        with pdfplumber.open(tmp_path) as pdf:
+                            pages = len(pdf.pages)
+                    except:
+                        pages = max(1, file_size // 50000)
+                else:
+                    # Estimate pages from text length
+                    pages = max(1, len(extracted_text) // 2000)
+            finally:
+                os.unlink(tmp_path)
     except Exception as e:
         logger.warning(f"⚠️ Failed to extract text from document: {e}")
         extracted_text = title or file.filename or "Untitled"
@@ -27,6 +27,8 @@ class Settings(BaseSettings):
     POSTGRES_USER: str = "postgres"
     POSTGRES_PASSWORD: str = "postgres"
     POSTGRES_DB: str = "sirius_dms"
+    DB_POOL_SIZE: int = 5  # Постоянные соединения пула на процесс (API и каждый Celery воркер)
+    DB_MAX_OVERFLOW: int = 10
     
     # Redis
     REDIS_URL: str = "redis://localhost:6379/0"
@@ -40,6 +42,9 @@ class Settings(BaseSettings):
     MINIO_SECRET_KEY: str = "minioadmin"
     MINIO_BUCKET_NAME: str = "sirius-documents"
     MINIO_USE_SSL: bool = False
+    # Keep-alive соединения клиента MinIO (по умолчанию в minio - 10): параллельные range-загрузки
+    # и HEAD-запросы иначе открывают новое TCP/TLS соединение на каждый запрос сверх пула
+    MINIO_MAX_POOL_CONNECTIONS: int = 64
     STORAGE_TOTAL_GB: float = 10.0  # Total storage limit in GB
     
     # JWT
@@ -55,14 +60,58 @@ class Settings(BaseSettings):
     QWEN_LOAD_IN_8BIT: bool = False
     QWEN_LOAD_IN_4BIT: bool = False
     QWEN_MAX_MEMORY_PERCENT: float = float(os.environ.get("QWEN_MAX_MEMORY_PERCENT", "95"))  # Процент памяти GPU для модели (остальное для буфера)
+    QWEN_SPECULATIVE: bool = False  # Speculative (assisted) decoding с маленькой draft-моделью
+    QWEN_DRAFT_MODEL_NAME: str = "Qwen/Qwen3-0.6B"  # Draft-модель (должна иметь тот же токенизатор)
+    QWEN_WARMUP_ON_STARTUP: bool = True  # Загружать и прогревать модель при старте, а не на первом запросе
+    QWEN_MIN_RELEVANCE: float = 0.6  # Минимальная similarity лучшего чанка, ниже которой ответ не генерируется
     
     # RAG
-    # Используется Qwen3-4B для генерации эмбеддингов (настроено через QWEN_MODEL_PATH)
-    RAG_EMBEDDING_MODEL: str = "qwen3-4b"  # Используется Qwen3-4B вместо SentenceTransformer
+    # Эмбеддинги считает компактный sentence encoder (EmbeddingService), Qwen3-4B - только генерация
+    # Имя/путь SentenceTransformer модели (GPU fp16/bf16, CPU - ONNX Runtime INT8);
+    # "qwen3-4b" - эмбеддинги из скрытых состояний Qwen3-4B (размерность 2560)
+    # При смене модели нужно изменить размерность столбца embedding (fix_vector_dimension.py)
+    # и переобработать документы
+    RAG_EMBEDDING_MODEL: str = "intfloat/multilingual-e5-small"
+    # Префиксы модели для запросов и фрагментов документов (e5: "query: " / "passage: ", для других моделей - "")
+    RAG_QUERY_PROMPT: str = "query: "
+    RAG_PASSAGE_PROMPT: str = "passage: "
+    # Размерность хранимых эмбеддингов (0 - родная размерность модели): SentenceTransformer -
+    # усечение Matryoshka (truncate_dim), qwen3-4b - PCA-проекция из RAG_EMBEDDING_PCA_PATH (fit_embedding_pca.py)
+    RAG_EMBEDDING_DIM: int = 0
+    RAG_EMBEDDING_PCA_PATH: str = os.environ.get("RAG_EMBEDDING_PCA_PATH", str(Path(__file__).parent.parent.parent / "models" / "embedding_pca.npz"))
+    RAG_EMBEDDING_CACHE_DIR: str = os.environ.get("RAG_EMBEDDING_CACHE_DIR", str(Path(__file__).parent.parent.parent / "models" / "embedding"))  # Экспортированная ONNX модель
+    # Эмбеддинги поисковых запросов: "default" - та же модель, что и для документов;
+    # "model2vec" - статические эмбеддинги Model2Vec (на порядки быстрее на CPU), только если
+    # корпус проиндексирован моделью той же размерности (RAG_EMBEDDING_MODEL на Model2Vec)
+    RAG_QUERY_BACKEND: str = "default"
+    RAG_QUERY_MODEL2VEC_MODEL: str = "minishlab/potion-base-8M"
+    RAG_QWEN_ONNX_CPU: bool = False  # RAG_EMBEDDING_MODEL=qwen3-4b на CPU: ONNX Runtime вместо PyTorch (однократный экспорт)
+    RAG_TORCH_COMPILE_POOLING: bool = False  # qwen3-4b на CUDA: пулинг и нормализация через torch.compile (слияние ядер)
+    RAG_FP16: bool = True  # Половинная точность для SentenceTransformer на GPU (bf16 на Ampere+); CPU всегда ONNX INT8
     RAG_TOP_K: int = 5
+    RAG_HNSW_EF_SEARCH: int = 40  # Ширина поиска HNSW индекса (больше - выше recall, медленнее)
+    RAG_RERANK_CANDIDATES_FACTOR: int = 4  # HNSW отбирает top_k * factor кандидатов, точный cosine считается в NumPy
+    # Отбор кандидатов по расстоянию Хэмминга бинарно квантованных эмбеддингов (HNSW bit_hamming_ops):
+    # 1 бит на измерение, дешевле cosine по halfvec; точный cosine затем по top_k * factor кандидатам
+    RAG_BINARY_PREFILTER: bool = False
+    RAG_BINARY_CANDIDATES_FACTOR: int = 10
     RAG_CHUNK_SIZE: int = 500
     RAG_CHUNK_OVERLAP: int = 100
     RAG_BATCH_SIZE: int = 4  # Оптимально для RTX 2050 (4GB VRAM), можно увеличить для более мощных карт
+    # Динамический батчинг конкурентных запросов эмбеддингов (поиск, загрузка документов)
+    RAG_DYNAMIC_BATCH_SIZE: int = 32
+    RAG_DYNAMIC_BATCH_DELAY_MS: float = 8.0
+    # То же для чанков документов: чанки нескольких документов кодируются одним вызовом модели
+    RAG_PASSAGE_BATCH_SIZE: int = 256
+    RAG_PASSAGE_BATCH_DELAY_MS: float = 50.0
+    RAG_CPU_ENCODE_WORKERS: int = 2  # Параллельные кодирования чанков на CPU (ONNX), потоки ORT делятся между ними
+    RAG_QUERY_EMBEDDING_CACHE_SIZE: int = 4096  # Локальный LRU-кэш эмбеддингов запросов (EmbeddingCache)
+    RAG_QUERY_EMBEDDING_CACHE_TTL: int = 600  # Секунды
+    RAG_QUERY_EMBEDDING_REDIS_TTL: int = 3600  # Общий для процессов кэш эмбеддингов запросов в Redis, секунды; 0 - отключен
+    # Семантический кэш поиска: запрос с cosine >= порога к закэшированному получает его результат
+    RAG_SEMANTIC_CACHE_SIZE: int = 1024  # 0 - кэш отключен
+    RAG_SEMANTIC_CACHE_THRESHOLD: float = 0.97
+    RAG_SEMANTIC_CACHE_TTL: int = 300  # Секунды; ограничивает устаревание при записи из других процессов (Celery)
     
     class Config:
         env_file = ".env"
@@ -3,7 +3,7 @@ Database configuration and session management
 """
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import text
+from sqlalchemy import event, text
 from app.core.config import settings
 import logging
 
@@ -16,8 +16,8 @@ engine = create_async_engine(
     echo=settings.DEBUG,
     future=True,
     pool_pre_ping=True,
-    pool_size=5,
-    max_overflow=10,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
     connect_args={
         "server_settings": {
             "application_name": "sirius_dms"
@@ -25,6 +25,20 @@ engine = create_async_engine(
     }
 )
 
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _register_pgvector(dbapi_connection, connection_record):
+    """Регистрирует бинарные кодеки pgvector (vector/halfvec) для asyncpg: ndarray передается без .tolist()"""
+    try:
+        from pgvector.asyncpg import register_vector
+        dbapi_connection.run_async(register_vector)
+    except Exception as e:
+        # Расширение vector может быть еще не создано (первый запуск init_db): такие соединения
+        # init_db закрывает после CREATE EXTENSION (engine.dispose), новые получают кодеки
+        logger.warning(f"⚠️ Не удалось зарегистрировать кодек pgvector: {e}")
+
+
 # Create async session factory
 AsyncSessionLocal = async_sessionmaker(
     engine,
@@ -37,6 +51,61 @@ AsyncSessionLocal = async_sessionmaker(
 # Base class for models
 Base = declarative_base()
 
+# Перевод document_chunks.embedding из vector(N) в halfvec(N) (FP16) с сохранением размерности
+# Идемпотентно: если столбец уже halfvec, ничего не делает
+EMBEDDING_HALFVEC_SQL = """
+    DO $$
+    DECLARE
+        dims integer;
+    BEGIN
+        SELECT a.atttypmod INTO dims
+        FROM pg_attribute a
+        JOIN pg_type t ON t.oid = a.atttypid
+        WHERE a.attrelid = 'document_chunks'::regclass
+          AND a.attname = 'embedding'
+          AND t.typname = 'vector';
+        IF dims IS NOT NULL AND dims > 0 THEN
+            DROP INDEX IF EXISTS ix_document_chunks_embedding;
+            EXECUTE format(
+                'ALTER TABLE document_chunks ALTER COLUMN embedding TYPE halfvec(%s) USING embedding::halfvec(%s)',
+                dims, dims
+            );
+        END IF;
+    END $$;
+"""
+
+# HNSW индекс по косинусному расстоянию для document_chunks.embedding (halfvec до 4000 измерений)
+EMBEDDING_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS ix_document_chunks_embedding
+    ON document_chunks
+    USING hnsw (embedding halfvec_cosine_ops)
+    WITH (m = 16, ef_construction = 64)
+"""
+
+# HNSW индекс по Хэммингу бинарно квантованных эмбеддингов (settings.RAG_BINARY_PREFILTER)
+# Выражение индекса фиксирует размерность: bit(N) берется из текущего halfvec(N)
+EMBEDDING_BINARY_INDEX_SQL = """
+    DO $$
+    DECLARE
+        dims integer;
+    BEGIN
+        SELECT a.atttypmod INTO dims
+        FROM pg_attribute a
+        JOIN pg_type t ON t.oid = a.atttypid
+        WHERE a.attrelid = 'document_chunks'::regclass
+          AND a.attname = 'embedding'
+          AND t.typname = 'halfvec';
+        IF dims IS NOT NULL AND dims > 0 THEN
+            EXECUTE format(
+                'CREATE INDEX IF NOT EXISTS ix_document_chunks_embedding_bin ON document_chunks '
+                'USING hnsw ((binary_quantize(embedding)::bit(%s)) bit_hamming_ops) '
+                'WITH (m = 16, ef_construction = 64)',
+                dims
+            );
+        END IF;
+    END $$;
+"""
+
 
 async def get_db() -> AsyncSession:
     """Dependency for getting database session"""
@@ -71,6 +140,21 @@ async def init_db():
             # Create all tables
             await conn.run_sync(Base.metadata.create_all)
         
+        # Соединения, открытые до CREATE EXTENSION, остались без кодеков pgvector и вернулись
+        # в пул: закрываем их, следующие соединения регистрируют кодеки при подключении
+        await engine.dispose()
+        
+        # ANN индекс для векторного поиска (отдельная транзакция - ошибка не откатывает создание таблиц)
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text(EMBEDDING_HALFVEC_SQL))
+                await conn.execute(text(EMBEDDING_INDEX_SQL))
+                if settings.RAG_BINARY_PREFILTER:
+                    await conn.execute(text(EMBEDDING_BINARY_INDEX_SQL))
+            logger.info("✅ HNSW index on document_chunks.embedding ready")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not create HNSW index on document_chunks.embedding: {e}")
+        
         logger.info("✅ Database initialized successfully")
     except Exception as e:
         logger.error(f"❌ Database initialization failed: {e}")
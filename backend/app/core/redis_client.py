@@ -9,17 +9,23 @@ import json
 logger = logging.getLogger(__name__)
 
 redis_client: redis.Redis = None
+# Клиент без декодирования ответов - для бинарных данных (файлы документов)
+redis_binary_client: redis.Redis = None
 
 
 async def init_redis():
     """Initialize Redis connection"""
-    global redis_client
+    global redis_client, redis_binary_client
     try:
         redis_client = redis.from_url(
             settings.REDIS_URL,
             encoding="utf-8",
             decode_responses=True
         )
+        redis_binary_client = redis.from_url(
+            settings.REDIS_URL,
+            decode_responses=False
+        )
         # Test connection
         await redis_client.ping()
         logger.info("✅ Redis connected successfully")
@@ -30,10 +36,12 @@ async def init_redis():
 
 async def close_redis():
     """Close Redis connection"""
-    global redis_client
+    global redis_client, redis_binary_client
     if redis_client:
         await redis_client.close()
         logger.info("Redis connection closed")
+    if redis_binary_client:
+        await redis_binary_client.close()
 
 
 async def get_redis() -> redis.Redis:
@@ -43,6 +51,13 @@ async def get_redis() -> redis.Redis:
     return redis_client
 
 
+async def get_redis_binary() -> redis.Redis:
+    """Get Redis client that returns raw bytes"""
+    if redis_binary_client is None:
+        await init_redis()
+    return redis_binary_client
+
+
 # Cache helpers
 async def cache_get(key: str) -> any:
     """Get value from cache"""
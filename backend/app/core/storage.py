@@ -4,7 +4,9 @@ MinIO/S3 storage configuration
 from minio import Minio
 from app.core.config import settings
 import logging
-from typing import Optional
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Optional, Tuple
 from datetime import timedelta
 import io
 
@@ -13,6 +15,26 @@ logger = logging.getLogger(__name__)
 # Initialize MinIO client
 minio_client: Optional[Minio] = None
 
+# Объекты от RANGE_DOWNLOAD_THRESHOLD скачиваются параллельными range-запросами по RANGE_PART_SIZE
+RANGE_DOWNLOAD_THRESHOLD = 10 << 20
+RANGE_PART_SIZE = 8 << 20
+RANGE_DOWNLOAD_WORKERS = 8
+
+
+def _minio_http_client():
+    """urllib3 пул с настройками клиента MinIO по умолчанию, но на MINIO_MAX_POOL_CONNECTIONS соединений"""
+    import certifi
+    import urllib3
+    
+    timeout = timedelta(minutes=5).seconds
+    return urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=timeout, read=timeout),
+        maxsize=settings.MINIO_MAX_POOL_CONNECTIONS,
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
+
 
 def init_storage():
     """Initialize MinIO client and create bucket if not exists"""
@@ -25,7 +47,8 @@ def init_storage():
             settings.MINIO_ENDPOINT,
             access_key=settings.MINIO_ACCESS_KEY,
             secret_key=settings.MINIO_SECRET_KEY,
-            secure=settings.MINIO_USE_SSL
+            secure=settings.MINIO_USE_SSL,
+            http_client=_minio_http_client()
         )
         
         # Create bucket if not exists
@@ -129,6 +152,81 @@ def download_file(object_name: str) -> bytes:
         raise
 
 
+def download_file_to(
+    fileobj: BinaryIO,
+    object_name: str,
+    chunk_size: int = 1 << 20,
+    size: Optional[int] = None
+) -> int:
+    """
+    Download file from MinIO directly into a file object, chunk by chunk
+    (память - один чанк, а не весь объект). Большие объекты в файлы на диске
+    скачиваются параллельными range-запросами (_download_ranges)
+    
+    Args:
+        fileobj: Writable binary file object
+        object_name: Object name in bucket
+        chunk_size: Read chunk size in bytes
+        size: Известный размер объекта (например, из get_file_stat) - без повторного HEAD запроса
+        
+    Returns:
+        Number of bytes written
+    """
+    from minio.error import S3Error
+    
+    client = get_storage()
+    
+    try:
+        if size is None:
+            size = client.stat_object(settings.MINIO_BUCKET_NAME, object_name).size
+        if size >= RANGE_DOWNLOAD_THRESHOLD and hasattr(os, "pwrite") and hasattr(fileobj, "fileno"):
+            _download_ranges(client, fileobj, object_name, size, chunk_size)
+            return size
+        
+        response = client.get_object(settings.MINIO_BUCKET_NAME, object_name)
+        try:
+            written = 0
+            for chunk in response.stream(chunk_size):
+                fileobj.write(chunk)
+                written += len(chunk)
+            return written
+        finally:
+            response.close()
+            response.release_conn()
+    except S3Error as e:
+        logger.error(f"❌ Download failed: {e}")
+        raise
+
+
+def _download_ranges(client: Minio, fileobj: BinaryIO, object_name: str, size: int, chunk_size: int):
+    """
+    Параллельная загрузка объекта частями (Range GET): каждая часть пишется os.pwrite
+    по своему смещению в заранее выделенный файл. Одно соединение ограничено по скорости,
+    несколько - нет
+    """
+    fileobj.flush()
+    fd = fileobj.fileno()
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fd, 0, size)
+    
+    def fetch_range(offset: int):
+        length = min(RANGE_PART_SIZE, size - offset)
+        response = client.get_object(settings.MINIO_BUCKET_NAME, object_name, offset=offset, length=length)
+        try:
+            position = offset
+            for chunk in response.stream(chunk_size):
+                os.pwrite(fd, chunk, position)
+                position += len(chunk)
+        finally:
+            response.close()
+            response.release_conn()
+    
+    with ThreadPoolExecutor(max_workers=RANGE_DOWNLOAD_WORKERS) as pool:
+        # list() - дождаться всех частей и пробросить первую ошибку
+        list(pool.map(fetch_range, range(0, size, RANGE_PART_SIZE)))
+    fileobj.seek(size)
+
+
 def delete_file(object_name: str):
     """Delete file from MinIO"""
     from minio.error import S3Error
@@ -196,3 +294,9 @@ def get_file_size(object_name: str) -> int:
         logger.error(f"❌ Failed to get file size: {e}")
         return 0
 
+
+def get_file_stat(object_name: str) -> Tuple[str, int]:
+    """Get object ETag and size in bytes (HEAD request, без загрузки содержимого)"""
+    client = get_storage()
+    stat = client.stat_object(settings.MINIO_BUCKET_NAME, object_name)
+    return stat.etag, stat.size
@@ -2,6 +2,7 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 import time
 
@@ -87,12 +88,20 @@ async def lifespan(app: FastAPI):
     # RAG and Qwen models temporarily disabled
     # logger.info("ℹ️ RAG and Qwen models disabled - documents will be saved directly to MinIO")
     
+    # Прогрев Qwen в фоне - не блокирует старт, но снимает задержку загрузки с первого запроса
+    warmup_task = None
+    if settings.QWEN_WARMUP_ON_STARTUP:
+        from app.services.qwen_service import qwen_service
+        warmup_task = asyncio.create_task(qwen_service.warmup())
+    
     logger.info("✅ Application ready")
     
     yield
     
     # Shutdown
     logger.info("🛑 Shutting down...")
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
     try:
         from app.core.redis_client import close_redis
         await close_redis()
@@ -160,6 +169,13 @@ async def health_check():
     }
 
 
+@app.get("/metrics")
+async def metrics():
+    """Cache hit/miss counters"""
+    from app.services.rag_service import rag_service
+    return rag_service.cache_stats()
+
+
 if __name__ == "__main__":
     import uvicorn
     # Исключаем файлы с моделью из автоперезагрузки чтобы не терять модель в памяти
@@ -17,7 +17,16 @@ logger = logging.getLogger(__name__)
 
 
 class DocumentProcessor:
-    """Process documents of various formats"""
+    """
+    Process documents of various formats
+    Состояния между вызовами не хранит (только настройки нарезки): один экземпляр можно
+    использовать из нескольких потоков. Объекты библиотек разбора (pdfplumber, python-docx,
+    openpyxl) привязаны к конкретному файлу и создаются на каждый вызов
+    """
+    
+    # Текстовые форматы: содержимое, уже загруженное в память, декодируется напрямую (load_text_bytes)
+    # без временного файла и парсеров
+    PLAIN_TEXT_EXTENSIONS = frozenset({'.txt', '.md', '.csv'})
     
     def __init__(self, chunk_size: int = 500, chunk_overlap: int = 100):
         self.chunk_size = chunk_size
@@ -55,23 +64,38 @@ class DocumentProcessor:
             logger.error(f"Ошибка при загрузке файла {file_path}: {e}")
             raise
     
+    def load_text_bytes(self, data: bytes, file_extension: str) -> str:
+        """Load plain text file content (PLAIN_TEXT_EXTENSIONS) from bytes"""
+        text = self._decode_text(data)
+        if file_extension.lower() == '.md':
+            return self._strip_markdown(text)
+        return text
+    
+    @staticmethod
+    def _decode_text(data: bytes) -> str:
+        """Decode text (utf-8, затем cp1251 и latin1) with universal newlines, как open(..., 'r')"""
+        for encoding in ['utf-8', 'cp1251']:
+            try:
+                text = data.decode(encoding)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            # latin1 декодирует любые байты
+            text = data.decode('latin1')
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+    
     def _load_txt(self, file_path: Path) -> str:
         """Load text file"""
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        except UnicodeDecodeError:
-            for encoding in ['cp1251', 'latin1', 'ascii']:
-                try:
-                    with open(file_path, 'r', encoding=encoding) as f:
-                        return f.read()
-                except UnicodeDecodeError:
-                    continue
-            raise UnicodeDecodeError(f"Не удалось определить кодировку файла {file_path}")
+        return self._decode_text(file_path.read_bytes())
     
     def _load_markdown(self, file_path: Path) -> str:
         """Load markdown file"""
-        text = self._load_txt(file_path)
+        return self._strip_markdown(self._load_txt(file_path))
+    
+    @staticmethod
+    def _strip_markdown(text: str) -> str:
+        """Remove markdown markup"""
         text = re.sub(r'^#{1,6}\s+', '', text, flags=re.MULTILINE)
         text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
         text = re.sub(r'\*(.*?)\*', r'\1', text) 
@@ -0,0 +1,67 @@
+"""
+Embedding cache - LRU + TTL кэш эмбеддингов по SHA-256 текста
+Повторный запрос возвращает готовый вектор без forward модели
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Потокобезопасный LRU-кэш эмбеддингов с TTL
+    Значения - L2-нормализованные float32 векторы только для чтения (разделяются между вызовами)
+    """
+
+    def __init__(self, max_size: int = 2048, ttl_seconds: float = 600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (embedding, created_at)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, embedding: np.ndarray) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding.flags.writeable = False
+        with self._lock:
+            self._entries[key] = (embedding, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return embedding
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
@@ -0,0 +1,109 @@
+"""
+Embedding service - компактный sentence encoder для RAG эмбеддингов
+Qwen3-4B остается только для генерации: эмбеддинги считает отдельная модель
+(по умолчанию intfloat/multilingual-e5-small, 384 измерения), на порядки меньше по весам
+"""
+import logging
+import os
+import threading
+from typing import List, Optional
+import numpy as np
+import torch
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# INT8 (dynamic quantization) ONNX модель для CPU с AVX-512 VNNI
+_ONNX_INT8_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+
+class EmbeddingService:
+    """
+    SentenceTransformer для эмбеддингов
+    GPU: PyTorch backend в fp16/bf16 (settings.RAG_FP16)
+    CPU: ONNX Runtime backend (INT8 quantized), при первом запуске модель
+    экспортируется и квантуется в RAG_EMBEDDING_CACHE_DIR
+    """
+
+    _instance = None
+    _model = None
+    _load_lock = threading.Lock()
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(EmbeddingService, cls).__new__(cls)
+        return cls._instance
+
+    def load(self):
+        """Load SentenceTransformer embedding model (lazy loading)"""
+        if self._model is not None:
+            return
+
+        with self._load_lock:
+            if self._model is not None:
+                return
+            EmbeddingService._model = self._load_model()
+
+    def _load_model(self):
+        from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+        # Усечение до RAG_EMBEDDING_DIM (Matryoshka) выполняется до L2-нормализации
+        truncate_dim = settings.RAG_EMBEDDING_DIM or None
+        
+        if torch.cuda.is_available():
+            model = SentenceTransformer(settings.RAG_EMBEDDING_MODEL, device="cuda", truncate_dim=truncate_dim)
+            if settings.RAG_FP16:
+                # bf16 на Ampere+ (нет переполнения при пулинге), иначе fp16
+                if torch.cuda.get_device_capability()[0] >= 8:
+                    model = model.to(torch.bfloat16)
+                else:
+                    model = model.half()
+            logger.info(f"✅ Модель эмбеддингов загружена на GPU: {settings.RAG_EMBEDDING_MODEL}")
+            return model
+
+        model_dir = settings.RAG_EMBEDDING_CACHE_DIR
+        if not os.path.isfile(os.path.join(model_dir, _ONNX_INT8_FILE)):
+            logger.info(f"📥 Экспорт {settings.RAG_EMBEDDING_MODEL} в ONNX INT8 (однократно)...")
+            export_model = SentenceTransformer(settings.RAG_EMBEDDING_MODEL, backend="onnx")
+            export_model.save_pretrained(model_dir)
+            export_dynamic_quantized_onnx_model(export_model, "avx512_vnni", model_dir)
+
+        import onnxruntime as ort
+        session_options = ort.SessionOptions()
+        # Потоки ORT делятся между параллельными кодированиями (RAGService._embed_texts_async)
+        session_options.intra_op_num_threads = max(1, (os.cpu_count() or 1) // settings.RAG_CPU_ENCODE_WORKERS)
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        model = SentenceTransformer(
+            model_dir,
+            backend="onnx",
+            model_kwargs={"file_name": _ONNX_INT8_FILE, "session_options": session_options},
+            truncate_dim=truncate_dim
+        )
+        logger.info(f"✅ Модель эмбеддингов загружена (ONNX INT8): {settings.RAG_EMBEDDING_MODEL}")
+        return model
+
+    def dimension(self) -> int:
+        """Размерность эмбеддингов модели"""
+        self.load()
+        return self._model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: List[str], batch_size: int = 32, prompt: Optional[str] = None) -> np.ndarray:
+        """
+        Эмбеддинги батча текстов (L2-нормализованные, float32)
+
+        Args:
+            texts: Тексты
+            batch_size: Размер батча модели
+            prompt: Префикс модели (для e5: "query: " / "passage: ")
+        """
+        self.load()
+        with torch.inference_mode():
+            embeddings = self._model.encode(
+                texts,
+                batch_size=batch_size,
+                prompt=prompt or None,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+        return embeddings.astype(np.float32)
@@ -9,12 +9,133 @@ from transformers import AutoTokenizer, AutoModelForCausalLM
 from typing import List, Optional, Dict, Any
 import logging
 import os
+import re
+import heapq
 import json
 import time
+import threading
+import orjson
+import zstandard as zstd
 from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Регулярные выражения для разбора ответа модели (компилируются один раз при импорте)
+_JSON_RE = re.compile(r'\{.*?"tags".*?\}', re.DOTALL)
+_JSON_FALLBACK_RE = re.compile(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}', re.DOTALL)
+_THINK_RE = re.compile(r'<think>.*?</think>', re.DOTALL)
+_SPECIAL_RE = re.compile(r'<\|.*?\|>')
+
+# Ключевые слова fallback-классификатора (порядок категорий = приоритет при совпадении нескольких)
+_DOC_TYPE_KEYWORDS = {
+    "contract": ("договор", "контракт", "соглашение"),
+    "invoice": ("счет", "invoice", "счет-фактура"),
+    "act": ("акт", "приемки", "выполнения"),
+    "order": ("приказ", "распоряжение", "order"),
+    "email": ("письмо", "email", "сообщение"),
+}
+_PRIORITY_KEYWORDS = {
+    "high": ("срочно", "urgent", "важно", "important"),
+    "low": ("низкий", "low", "неважно"),
+}
+_DOC_TYPE_ORDER = tuple(_DOC_TYPE_KEYWORDS)
+_PRIORITY_ORDER = tuple(_PRIORITY_KEYWORDS)
+# Сколько символов начала документа сканирует fallback-классификатор
+_FALLBACK_SCAN_CHARS = 8192
+
+# Без pyahocorasick: одно регулярное выражение на категорию (один проход по тексту на категорию
+# вместо поиска каждого слова отдельно)
+_DOC_TYPE_PATTERNS = {
+    label: re.compile("|".join(map(re.escape, words))) for label, words in _DOC_TYPE_KEYWORDS.items()
+}
+_PRIORITY_PATTERNS = {
+    label: re.compile("|".join(map(re.escape, words))) for label, words in _PRIORITY_KEYWORDS.items()
+}
+
+
+def _build_keyword_automaton():
+    """Aho-Corasick автомат по всем ключевым словам: один проход по тексту вместо проверки каждого слова"""
+    try:
+        import ahocorasick
+    except ImportError:
+        logger.info("ℹ️ pyahocorasick не установлен, fallback-классификатор использует регулярные выражения")
+        return None
+    
+    automaton = ahocorasick.Automaton()
+    for category, groups in (("type", _DOC_TYPE_KEYWORDS), ("priority", _PRIORITY_KEYWORDS)):
+        for label, words in groups.items():
+            for word in words:
+                automaton.add_word(word, (category, label))
+    automaton.make_automaton()
+    return automaton
+
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton()
+
+# Сжатие файлов документов в Redis. Первый байт значения - формат (для совместимости)
+# Используем zstd.compress/decompress: объекты ZstdCompressor не потокобезопасны,
+# а сохранение в Redis вызывается из фоновых потоков
+_ZSTD_LEVEL = 3
+_PAYLOAD_RAW = b'\x00'
+_PAYLOAD_ZSTD = b'\x01'
+_DOCUMENT_TTL = 86400 * 7  # 7 дней
+
+# Шаблон промпта классификации: префикс/суффикс токенизируются один раз при загрузке модели,
+# текст документа обрезается по числу токенов, а не символов
+_CLASSIFY_PREFIX = """Проанализируй следующий документ и определи:
+1. Тип документа (contract, invoice, act, order, email, scan, document, presentation, report)
+2. Название организации-контрагента (если есть)
+3. Дату документа (если есть)
+4. Приоритет (high, medium, low)
+5. Краткое описание (1-2 предложения)
+6. Теги - выдели 3-7 ключевых слов/фраз, которые характеризуют документ (например: "договор", "поставка", "2024", "ООО Рога", "техническая документация")
+
+Текст документа:
+"""
+_CLASSIFY_SUFFIX = """
+
+Ответь в формате JSON:
+{
+    "type": "тип документа",
+    "counterparty_name": "название организации или null",
+    "date": "YYYY-MM-DD или null",
+    "priority": "high/medium/low",
+    "description": "краткое описание",
+    "tags": ["тег1", "тег2", "тег3"]
+}"""
+_CLASSIFY_MAX_TEXT_TOKENS = 800
+
+# JSON-схема ответа классификации (для ограниченного декодирования)
+_CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "type": {
+            "type": "string",
+            "enum": ["contract", "invoice", "act", "order", "email", "scan", "document", "presentation", "report"]
+        },
+        "counterparty_name": {"type": ["string", "null"], "maxLength": 200},
+        "date": {"type": ["string", "null"], "maxLength": 10},
+        "priority": {"type": "string", "enum": ["high", "medium", "low"]},
+        "description": {"type": "string", "maxLength": 300},
+        "tags": {"type": "array", "items": {"type": "string", "maxLength": 50}, "maxItems": 7}
+    },
+    "required": ["type", "counterparty_name", "date", "priority", "description", "tags"]
+}
+# Предел генерации ответа классификации при декодировании по схеме: максимальные длины строк
+# схемы в токенах (токенизатор Qwen кодирует русский текст в среднем по 2+ символа на токен)
+# плюс ключи, значения enum, кавычки и разделители. Ответ в рамках схемы не обрезается посреди JSON
+_CLASSIFY_CHARS_PER_TOKEN = 2
+_CLASSIFY_SCHEMA_MAX_NEW_TOKENS = (
+    _CLASSIFICATION_SCHEMA["properties"]["counterparty_name"]["maxLength"]
+    + _CLASSIFICATION_SCHEMA["properties"]["date"]["maxLength"]
+    + _CLASSIFICATION_SCHEMA["properties"]["description"]["maxLength"]
+    + _CLASSIFICATION_SCHEMA["properties"]["tags"]["maxItems"]
+    * _CLASSIFICATION_SCHEMA["properties"]["tags"]["items"]["maxLength"]
+) // _CLASSIFY_CHARS_PER_TOKEN + 96
+# Без lm-format-enforcer длину ответа схема не ограничивает: свободная генерация обрезается
+# прежним коротким пределом, чтобы укладываться в таймаут
+_CLASSIFY_FREE_MAX_NEW_TOKENS = 128
+
 
 class QwenService:
     """Service for Qwen model operations"""
@@ -22,6 +143,14 @@ class QwenService:
     _instance = None
     _model = None
     _tokenizer = None
+    _draft_model = None  # Draft-модель для speculative decoding (settings.QWEN_SPECULATIVE)
+    _device = None  # Устройство модели (кэшируется при загрузке)
+    _pad_id = None
+    _eos_id = None
+    _cls_prefix_ids = None  # Токены шаблона классификации (кэшируются при загрузке)
+    _cls_suffix_ids = None
+    _enforcer_tokenizer_data = None  # Кэш словаря токенов для lm-format-enforcer (False - недоступен)
+    _load_lock = threading.Lock()  # Прогрев, эмбеддинги и запросы не должны загружать модель параллельно
     
     def __new__(cls):
         if cls._instance is None:
@@ -36,14 +165,36 @@ class QwenService:
     def _ensure_model_loaded(self):
         """Ensure model is loaded (lazy loading) - вызывается только при первом использовании"""
         
-        if self._model is None or self._tokenizer is None:
-            logger.info("🔄 Загрузка модели Qwen из локальной папки (lazy loading, первый запрос)...")
-            try:
-                self._load_model()
-                logger.info("✅ Модель загружена, готова к использованию")
-            except Exception as e:
-                logger.error(f"❌ Failed to load Qwen model: {e}", exc_info=True)
-                raise
+        if self._model is not None and self._tokenizer is not None:
+            return
+        
+        with self._load_lock:
+            if self._model is None or self._tokenizer is None:
+                logger.info("🔄 Загрузка модели Qwen из локальной папки (lazy loading, первый запрос)...")
+                try:
+                    self._load_model()
+                    logger.info("✅ Модель загружена, готова к использованию")
+                except Exception as e:
+                    logger.error(f"❌ Failed to load Qwen model: {e}", exc_info=True)
+                    raise
+    
+    async def warmup(self):
+        """
+        Загрузить модель заранее (при старте приложения) в отдельном потоке
+        и прогнать генерацию одного токена, чтобы первый запрос не упирался в таймаут
+        """
+        import asyncio
+        
+        try:
+            logger.info("🔥 Прогрев модели Qwen...")
+            await asyncio.to_thread(self._ensure_model_loaded)
+            if self._model is None:
+                logger.warning("⚠️ Прогрев пропущен: модель не загружена (fallback режим)")
+                return
+            await asyncio.to_thread(self._generate_text, "warmup", max_new_tokens=1, greedy=True)
+            logger.info("✅ Модель Qwen прогрета")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прогреть модель Qwen: {e}")
     
     def get_memory_info(self) -> Dict[str, Any]:
         """Получить информацию об использовании памяти GPU"""
@@ -86,18 +237,17 @@ class QwenService:
                     weight_map = index_data.get('weight_map', {})
                     required_files = set(weight_map.values())
                     # Проверяем только существование файлов, не загружаем
-                    all_files_exist = all(
-                        os.path.isfile(os.path.join(model_path, fname))
-                        for fname in required_files
-                    )
+                    # Одно чтение директории вместо stat на каждый шард
+                    with os.scandir(model_path) as entries:
+                        present = {entry.name for entry in entries if entry.is_file()}
+                    missing = required_files - present
                     
-                    if all_files_exist:
+                    if not missing:
                         use_local = True
                         model_name = model_path
                         logger.info(f"✅ Найдена локальная модель: {model_path}, начинаю загрузку...")
                     else:
-                        missing = [f for f in required_files if not os.path.isfile(os.path.join(model_path, f))]
-                        logger.warning(f"⚠️ Локальная модель неполная, отсутствуют файлы: {missing[:5]}")
+                        logger.warning(f"⚠️ Локальная модель неполная, отсутствуют файлы: {sorted(missing)[:5]}")
                 except Exception as e:
                     logger.warning(f"⚠️ Ошибка при проверке локальной модели: {e}")
             else:
@@ -119,12 +269,13 @@ class QwenService:
             max_memory = {0: f"{max_memory_bytes // (1024**3)}GiB"}  # Формат для accelerate
             
             model_kwargs = {
-                "dtype": torch.float16,  # Используем float16 для GPU (быстрее и меньше памяти)
+                "dtype": self._get_cuda_dtype(),  # Половинная точность для GPU (быстрее и меньше памяти)
                 "device_map": "auto",  # Автоматическое распределение по GPU
                 "max_memory": max_memory,  # Ограничение памяти для модели
                 "trust_remote_code": True,
                 "local_files_only": use_local,
-                "torch_dtype": torch.float16,  # Явно указываем dtype для ускорения
+                "torch_dtype": self._get_cuda_dtype(),  # Явно указываем dtype для ускорения
+                "attn_implementation": self._get_attn_implementation(),
             }
             logger.info(f"💾 Использование памяти GPU: {settings.QWEN_MAX_MEMORY_PERCENT}% для модели, {100 - settings.QWEN_MAX_MEMORY_PERCENT}% для буфера")
         else:
@@ -132,7 +283,8 @@ class QwenService:
                 "dtype": torch.float32,  # Always use float32 for CPU compatibility
                 "device_map": None,  # Explicitly set to None for CPU
                 "trust_remote_code": True,
-                "local_files_only": use_local
+                "local_files_only": use_local,
+                "attn_implementation": "sdpa",  # Fused attention PyTorch и на CPU, а не eager
             }
         
         # Quantization для экономии памяти (особенно полезно для Mac)
@@ -145,23 +297,27 @@ class QwenService:
         
         try:
             logger.info("📥 Загрузка токенизатора...")
-            # Для Qwen3 используем Qwen2Tokenizer (Qwen3 использует тот же токенизатор)
+            # Для Qwen3 используем Qwen2TokenizerFast (Qwen3 использует тот же токенизатор):
+            # Rust-реализация токенизирует батч параллельно и отпускает GIL
             try:
-                from transformers import Qwen2Tokenizer
-                logger.info("Используем Qwen2Tokenizer для Qwen3 модели...")
-                self._tokenizer = Qwen2Tokenizer.from_pretrained(
+                from transformers import Qwen2TokenizerFast
+                logger.info("Используем Qwen2TokenizerFast для Qwen3 модели...")
+                self._tokenizer = Qwen2TokenizerFast.from_pretrained(
                     model_name,
                     trust_remote_code=True,
                     local_files_only=use_local
                 )
             except (ImportError, Exception) as tokenizer_error:
-                logger.warning(f"⚠️ Qwen2Tokenizer недоступен ({tokenizer_error}), пробуем AutoTokenizer...")
+                logger.warning(f"⚠️ Qwen2TokenizerFast недоступен ({tokenizer_error}), пробуем AutoTokenizer...")
                 # Fallback на AutoTokenizer
                 self._tokenizer = AutoTokenizer.from_pretrained(
                     model_name,
+                    use_fast=True,
                     trust_remote_code=True,
                     local_files_only=use_local
                 )
+            if not getattr(self._tokenizer, "is_fast", False):
+                logger.warning("⚠️ Загружен медленный (Python) токенизатор: токенизация батчей не распараллеливается")
             
             logger.info("📥 Загрузка модели (это может занять время)...")
             try:
@@ -208,15 +364,22 @@ class QwenService:
             
             self._model.eval()  # Set to evaluation mode
             
-            # Финальная проверка устройства
+            # Финальная проверка устройства - кэшируем его, чтобы не обходить параметры модели на каждый вызов
             try:
-                final_device = next(self._model.parameters()).device
-                logger.info(f"✅ Финальная проверка: модель на устройстве {final_device}")
+                self._device = next(self._model.parameters()).device
+                logger.info(f"✅ Финальная проверка: модель на устройстве {self._device}")
             except Exception as e:
                 logger.warning(f"⚠️ Не удалось проверить финальное устройство: {e}")
             
             if self._tokenizer.pad_token is None:
                 self._tokenizer.pad_token = self._tokenizer.eos_token
+            self._pad_id = self._tokenizer.pad_token_id
+            self._eos_id = self._tokenizer.eos_token_id
+            self._cls_prefix_ids = self._tokenizer.encode(_CLASSIFY_PREFIX, add_special_tokens=False)
+            self._cls_suffix_ids = self._tokenizer.encode(_CLASSIFY_SUFFIX, add_special_tokens=False)
+            
+            if settings.QWEN_SPECULATIVE:
+                self._load_draft_model(device)
             
             logger.info(f"✅ Модель Qwen успешно загружена на устройстве {device}")
             
@@ -228,6 +391,55 @@ class QwenService:
                 self._tokenizer.pad_token = self._tokenizer.eos_token
             logger.warning("⚠️ Модель не загружена, будет использован fallback режим (классификация по ключевым словам)")
     
+    def _load_draft_model(self, device: str):
+        """
+        Загрузить маленькую draft-модель для speculative decoding:
+        она предлагает несколько токенов, основная модель проверяет их за один forward
+        """
+        logger.info(f"📥 Загрузка draft-модели {settings.QWEN_DRAFT_MODEL_NAME} для speculative decoding...")
+        try:
+            self._draft_model = AutoModelForCausalLM.from_pretrained(
+                settings.QWEN_DRAFT_MODEL_NAME,
+                torch_dtype=self._get_cuda_dtype() if device == "cuda" else torch.float32,
+                device_map="auto" if device == "cuda" else None,
+                trust_remote_code=True
+            )
+            if device != "cuda":
+                self._draft_model = self._draft_model.to(self._device)
+            self._draft_model.eval()
+            logger.info("✅ Draft-модель загружена")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось загрузить draft-модель ({e}), генерация без speculative decoding")
+            self._draft_model = None
+    
+    def _get_cuda_dtype(self) -> torch.dtype:
+        """
+        dtype весов на CUDA: bf16 на Ampere+ (тот же диапазон, что у fp32 - скрытые состояния
+        для эмбеддингов не переполняются), иначе fp16
+        """
+        try:
+            if torch.cuda.get_device_capability()[0] >= 8:
+                return torch.bfloat16
+        except Exception:
+            pass
+        return torch.float16
+    
+    def _get_attn_implementation(self) -> str:
+        """
+        Выбрать реализацию attention для CUDA:
+        FlashAttention 2 на Ampere+ (если установлен flash-attn), иначе SDPA (fused kernel PyTorch)
+        """
+        try:
+            if torch.cuda.get_device_capability()[0] >= 8:
+                import flash_attn  # noqa: F401
+                logger.info("⚡ Используется FlashAttention 2")
+                return "flash_attention_2"
+        except ImportError:
+            logger.info("flash-attn не установлен, используется SDPA")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось определить поддержку FlashAttention: {e}, используется SDPA")
+        return "sdpa"
+    
     def _get_best_device(self) -> str:
         """Get best available device"""
         # Check if device is forced via settings
@@ -251,6 +463,50 @@ class QwenService:
         else:
             return "cpu"
     
+    def _build_classification_input_ids(self, text: str) -> torch.Tensor:
+        """
+        Собрать input_ids промпта классификации из заранее токенизированного шаблона
+        и текста документа, обрезанного до _CLASSIFY_MAX_TEXT_TOKENS токенов
+        """
+        # Срез по символам с запасом - не токенизируем многомегабайтные документы целиком
+        body_ids = self._tokenizer.encode(
+            text[:_CLASSIFY_MAX_TEXT_TOKENS * 8],
+            add_special_tokens=False
+        )[:_CLASSIFY_MAX_TEXT_TOKENS]
+        
+        bos = [self._tokenizer.bos_token_id] if self._tokenizer.bos_token_id is not None else []
+        return torch.tensor([bos + self._cls_prefix_ids + body_ids + self._cls_suffix_ids])
+    
+    def _build_json_logits_processor(self):
+        """
+        Построить LogitsProcessor, ограничивающий генерацию схемой _CLASSIFICATION_SCHEMA
+        Возвращает None если lm-format-enforcer не установлен
+        """
+        if self._enforcer_tokenizer_data is False:
+            return None
+        
+        try:
+            from lmformatenforcer import JsonSchemaParser
+            from lmformatenforcer.integrations.transformers import (
+                build_token_enforcer_tokenizer_data,
+                build_transformers_prefix_allowed_tokens_fn,
+            )
+            from transformers import LogitsProcessorList, PrefixConstrainedLogitsProcessor
+        except ImportError as e:
+            logger.warning(f"⚠️ lm-format-enforcer недоступен ({e}), JSON будет извлекаться из свободного текста")
+            self._enforcer_tokenizer_data = False
+            return None
+        
+        # Разбор словаря токенизатора дорогой - делаем один раз
+        if self._enforcer_tokenizer_data is None:
+            self._enforcer_tokenizer_data = build_token_enforcer_tokenizer_data(self._tokenizer)
+        
+        prefix_fn = build_transformers_prefix_allowed_tokens_fn(
+            self._enforcer_tokenizer_data,
+            JsonSchemaParser(_CLASSIFICATION_SCHEMA)
+        )
+        return LogitsProcessorList([PrefixConstrainedLogitsProcessor(prefix_fn, num_beams=1)])
+    
     async def classify_metrics_from_rag(
         self,
         metrics: Dict[str, any]
@@ -281,40 +537,38 @@ class QwenService:
                 "text_length": metrics.get("text_length", 0)
             }
         
-        prompt = f"""Проанализируй следующий документ и определи:
-1. Тип документа (contract, invoice, act, order, email, scan, document, presentation, report)
-2. Название организации-контрагента (если есть)
-3. Дату документа (если есть)
-4. Приоритет (high, medium, low)
-5. Краткое описание (1-2 предложения)
-6. Теги - выдели 3-7 ключевых слов/фраз, которые характеризуют документ (например: "договор", "поставка", "2024", "ООО Рога", "техническая документация")
-
-Текст документа:
-{text[:2000]}
-
-Ответь в формате JSON:
-{{
-    "type": "тип документа",
-    "counterparty_name": "название организации или null",
-    "date": "YYYY-MM-DD или null",
-    "priority": "high/medium/low",
-    "description": "краткое описание",
-    "tags": ["тег1", "тег2", "тег3"]
-}}"""
+        # Fallback режим: загрузка не бросает исключение, но модель или шаблон промпта не готовы
+        if self._model is None or self._tokenizer is None or self._cls_prefix_ids is None:
+            return {
+                "classification": self._fallback_classify(text, filename),
+                "processed": False,
+                "error": "Model not available",
+                "chunks_count": metrics.get("chunks_count", 0),
+                "text_length": metrics.get("text_length", 0)
+            }
         
         try:
+            prompt_ids = self._build_classification_input_ids(text)
+            
             logger.info(f"🔄 Начинаю генерацию классификации для {filename}...")
             import asyncio
             import signal
             
+            logits_processor = self._build_json_logits_processor()
+            
             # Запускаем генерацию с таймаутом
             try:
                 response = await asyncio.wait_for(
                     asyncio.to_thread(
                         self._generate_text,
-                        prompt=prompt,
-                        max_new_tokens=256,
-                        temperature=0.3
+                        prompt_ids=prompt_ids,
+                        max_new_tokens=(
+                            _CLASSIFY_SCHEMA_MAX_NEW_TOKENS if logits_processor is not None
+                            else _CLASSIFY_FREE_MAX_NEW_TOKENS
+                        ),
+                        temperature=0.3,
+                        greedy=True,
+                        logits_processor=logits_processor
                     ),
                     timeout=60.0  # 60 секунд таймаут
                 )
@@ -331,16 +585,22 @@ class QwenService:
                 }
             
             # Parse JSON from response
-            import re
-            # Ищем JSON объект в ответе (может быть многострочным)
-            json_match = re.search(r'\{.*?"tags".*?\}', response, re.DOTALL)
-            if not json_match:
-                # Пробуем найти любой JSON объект
-                json_match = re.search(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}', response, re.DOTALL)
-            
-            if json_match:
+            if logits_processor is not None:
+                # Декодирование ограничено схемой - ответ сразу является JSON
+                json_text = response
+            else:
+                # Ищем JSON объект в ответе (может быть многострочным)
+                json_match = _JSON_RE.search(response)
+                if not json_match:
+                    # Пробуем найти любой JSON объект
+                    json_match = _JSON_FALLBACK_RE.search(response)
+                json_text = json_match.group() if json_match else None
+            
+            # Классификация получена от модели (False - ответ не разобран, использован fallback)
+            processed = bool(json_text)
+            if json_text:
                 try:
-                    classification = json.loads(json_match.group())
+                    classification = orjson.loads(json_text)
                     # Убеждаемся, что tags - это список
                     if "tags" in classification and not isinstance(classification["tags"], list):
                         if isinstance(classification["tags"], str):
@@ -350,9 +610,10 @@ class QwenService:
                             classification["tags"] = []
                     elif "tags" not in classification:
                         classification["tags"] = []
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
                     logger.warning(f"⚠️ Не удалось распарсить JSON ответ: {e}, используем fallback")
                     classification = self._fallback_classify(text, filename)
+                    processed = False
             else:
                 classification = self._fallback_classify(text, filename)
                 classification["tags"] = []
@@ -360,7 +621,7 @@ class QwenService:
             # Формируем обратные метрики для RAG → Postgres
             reverse_metrics = {
                 "classification": classification,
-                "processed": True,
+                "processed": processed,
                 "chunks_count": metrics.get("chunks_count", 0),
                 "text_length": metrics.get("text_length", 0)
             }
@@ -392,25 +653,32 @@ class QwenService:
             metadata: Метаданные документа
         """
         try:
-            from app.core.redis_client import get_redis
-            import base64
+            from app.core.redis_client import get_redis_binary
             
-            redis = await get_redis()
+            redis = await get_redis_binary()
             
-            # Кодируем файл в base64 для хранения в Redis
-            file_base64 = base64.b64encode(file_data).decode('utf-8')
+            # Файл храним отдельным ключом в сжатом виде (zstd), без base64. Уже сжатые форматы
+            # (docx, xlsx, большинство PDF) zstd не уменьшает - их храним как есть (_PAYLOAD_RAW)
+            # и не распаковываем при чтении
+            compressed = zstd.compress(file_data, _ZSTD_LEVEL)
+            if len(compressed) < len(file_data):
+                compressed = _PAYLOAD_ZSTD + compressed
+            else:
+                compressed = _PAYLOAD_RAW + file_data
             
-            # Сохраняем документ
+            # Сохраняем документ (orjson сразу возвращает bytes)
             document_key = f"document:{document_id}"
-            await redis.setex(
-                document_key,
-                86400 * 7,  # 7 дней
-                json.dumps({
-                    "data": file_base64,
-                    "metadata": metadata,
-                    "size": len(file_data)
-                })
-            )
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.setex(
+                    document_key,
+                    _DOCUMENT_TTL,
+                    orjson.dumps({
+                        "metadata": metadata,
+                        "size": len(file_data)
+                    })
+                )
+                pipe.setex(f"{document_key}:data", _DOCUMENT_TTL, compressed)
+                await pipe.execute()
             
             logger.info(f"✅ Qwen сохранил документ {document_id} в Redis")
             
@@ -433,18 +701,27 @@ class QwenService:
             Данные документа или None
         """
         try:
-            from app.core.redis_client import get_redis
+            from app.core.redis_client import get_redis_binary
             import base64
             
-            redis = await get_redis()
+            redis = await get_redis_binary()
             
             document_key = f"document:{document_id}"
-            data = await redis.get(document_key)
+            data, raw_file = await redis.mget([document_key, f"{document_key}:data"])
             
             if data:
-                document_data = json.loads(data)
+                document_data = orjson.loads(data)
                 # Декодируем файл
-                file_data = base64.b64decode(document_data["data"])
+                if "data" in document_data:
+                    # Старый формат: файл в base64 внутри JSON
+                    file_data = base64.b64decode(document_data["data"])
+                elif raw_file is None:
+                    return None
+                elif raw_file[:1] == _PAYLOAD_ZSTD:
+                    file_data = zstd.decompress(raw_file[1:])
+                else:
+                    # _PAYLOAD_RAW
+                    file_data = raw_file[1:]
                 return {
                     "data": file_data,
                     "metadata": document_data.get("metadata", {}),
@@ -493,12 +770,23 @@ class QwenService:
                 }
             
             # Формируем контекст для ответа (используем больше чанков для лучшего контекста)
-            # Сортируем чанки по similarity для приоритета наиболее релевантных
-            sorted_chunks = sorted(chunks, key=lambda x: x.get('similarity', 0.0), reverse=True)
+            # Берем топ-10 чанков по similarity для приоритета наиболее релевантных (без полной сортировки)
+            top_chunks = heapq.nlargest(10, chunks, key=lambda x: x.get('similarity', 0.0))
+            
+            # Если даже лучший чанк нерелевантен - не тратим генерацию на заведомо пустой ответ
+            best_sim = top_chunks[0].get('similarity', 0.0) if top_chunks else 0.0
+            if best_sim < settings.QWEN_MIN_RELEVANCE:
+                logger.info(f"⚠️ Лучшая similarity {best_sim:.3f} < {settings.QWEN_MIN_RELEVANCE}, генерацию пропускаем")
+                return {
+                    "answer": "По вашему запросу документы не найдены",
+                    "documents": [],
+                    "chunks": chunks,
+                    "query": query
+                }
             
             context = "\n\n".join([
                 f"Документ: {chunk['document_title']} (релевантность: {chunk.get('similarity', 0.0):.3f})\n{chunk['text'][:400]}"
-                for chunk in sorted_chunks[:10]  # Используем топ-10 наиболее релевантных чанков
+                for chunk in top_chunks  # Используем топ-10 наиболее релевантных чанков
             ])
             
             # Генерируем ответ на основе контекста с акцентом на релевантность
@@ -523,45 +811,42 @@ class QwenService:
                 temperature=0.7
             )
             
-            # Собираем уникальные документы из релевантных чанков
-            # Группируем чанки по документам и берем максимальную similarity для каждого документа
-            seen_doc_ids = {}
-            documents = []
-            
-            # Проходим по всем чанкам и собираем уникальные документы с максимальной similarity
-            for chunk in sorted_chunks:  # Используем уже отсортированные чанки
+            # Собираем уникальные документы из релевантных чанков за один проход:
+            # для каждого документа запоминаем чанк с максимальной similarity
+            best = {}
+            for chunk in chunks:
                 doc_id = chunk["document_id"]
                 similarity = chunk.get("similarity", 0.0)
-                
-                # Если документ уже добавлен, обновляем similarity если текущий чанк более релевантен
-                if doc_id in seen_doc_ids:
-                    if similarity > seen_doc_ids[doc_id].get("similarity", 0.0):
-                        seen_doc_ids[doc_id]["similarity"] = similarity
-                    continue
-                
-                # Пытаемся получить из Redis
-                logger.debug(f"🔍 Qwen → Redis: проверяю документ {doc_id}")
-                doc_data = await self.get_document_from_redis(doc_id)
-                
-                # Добавляем документ с максимальной similarity
-                doc_info = {
+                if doc_id not in best or similarity > best[doc_id][0]:
+                    best[doc_id] = (similarity, chunk)
+            
+            # Сортируем документы по similarity (релевантности) - наиболее релевантные первыми
+            documents = [
+                {
                     "document_id": doc_id,
                     "title": chunk["document_title"],
                     "type": chunk["document_type"],
                     "path": chunk.get("document_path"),
-                    "available": doc_data is not None,
+                    "available": False,
                     "similarity": similarity
                 }
-                seen_doc_ids[doc_id] = doc_info
-                documents.append(doc_info)
-                
-                if doc_data:
-                    logger.debug(f"✅ Qwen → Redis: документ {doc_id} найден в Redis")
-                else:
-                    logger.debug(f"⚠️ Qwen → Redis: документ {doc_id} не найден в Redis (используем данные из Postgres)")
+                for doc_id, (similarity, chunk) in best.items()
+            ]
+            documents.sort(key=lambda x: x["similarity"], reverse=True)
             
-            # Сортируем документы по similarity (релевантности) - наиболее релевантные первыми
-            documents.sort(key=lambda x: x.get("similarity", 0.0), reverse=True)
+            # Проверяем наличие документов в Redis одним MGET (один round-trip вместо N)
+            # Содержимое не декодируем - здесь нужна только доступность
+            if documents:
+                try:
+                    from app.core.redis_client import get_redis
+                    
+                    redis = await get_redis()
+                    raw = await redis.mget([f"document:{doc['document_id']}" for doc in documents])
+                    for doc, data in zip(documents, raw):
+                        doc["available"] = data is not None
+                    logger.debug(f"🔍 Qwen → Redis: в Redis найдено {sum(doc['available'] for doc in documents)}/{len(documents)} документов")
+                except Exception as e:
+                    logger.warning(f"⚠️ Qwen → Redis: не удалось проверить документы ({e}), используем данные из Postgres")
             
             # Фильтруем документы с очень низкой релевантностью
             # Используем более строгий порог (0.85) из-за высокой similarity между всеми документами
@@ -608,60 +893,92 @@ class QwenService:
     
     def _generate_text(
         self,
-        prompt: str,
+        prompt: Optional[str] = None,
         max_new_tokens: int = 512,
         temperature: float = 0.7,
-        top_p: float = 0.9
+        top_p: float = 0.9,
+        greedy: bool = False,
+        logits_processor=None,
+        prompt_ids: Optional[torch.Tensor] = None
     ) -> str:
-        """Generate text using Qwen model"""
+        """
+        Generate text using Qwen model
+        
+        greedy=True отключает сэмплинг (argmax) - для структурированных ответов (JSON)
+        logits_processor - ограничение декодирования (например, JSON-схемой);
+        в этом случае ответ возвращается целиком, без обрезки до первой строки
+        prompt_ids - уже токенизированный промпт (вместо prompt)
+        """
         if self._model is None or self._tokenizer is None:
             raise RuntimeError("Model not loaded")
         
         try:
             # Используем устройство на котором находится модель (GPU или CPU)
-            device = next(self._model.parameters()).device
+            device = self._device
             logger.info(f"🚀 Генерация на устройстве: {device}")
-            logger.info(f"📝 Длина промпта: {len(prompt)} символов, max_new_tokens: {max_new_tokens}")
-            
-            inputs = self._tokenizer(
-                prompt,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=2048
-            )
             
+            # Одна последовательность: encode без логики паддинга, маска - из единиц
             # Inputs на том же устройстве что и модель
-            inputs = {k: v.to(device) for k, v in inputs.items()}
+            if prompt_ids is None:
+                prompt_ids = self._tokenizer.encode(
+                    prompt,
+                    return_tensors="pt",
+                    truncation=True,
+                    max_length=2048
+                )
+            input_ids = prompt_ids.to(device, non_blocking=True)
+            logger.info(f"📝 Длина промпта: {input_ids.shape[1]} токенов, max_new_tokens: {max_new_tokens}")
+            attention_mask = torch.ones_like(input_ids)
             logger.info(f"🔄 Начинаю generate() на {device}...")
             
-            with torch.no_grad():
+            if greedy:
+                # Без multinomial-сэмплинга и O(vocab) repetition_penalty на каждом токене
+                sampling_kwargs = {
+                    "do_sample": False,
+                    "num_beams": 1,
+                    "temperature": None,
+                    "top_p": None,
+                    "repetition_penalty": 1.0,
+                }
+            else:
+                sampling_kwargs = {
+                    "do_sample": True,
+                    "temperature": temperature,
+                    "top_p": top_p,
+                    "repetition_penalty": 1.2,
+                }
+            
+            if logits_processor is not None:
+                sampling_kwargs["logits_processor"] = logits_processor
+            if self._draft_model is not None:
+                # Assisted decoding (HF transformers): draft предлагает токены, основная модель верифицирует
+                sampling_kwargs["assistant_model"] = self._draft_model
+            
+            with torch.inference_mode():
                 outputs = self._model.generate(
-                    **inputs,
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
                     max_new_tokens=max_new_tokens,
-                    temperature=temperature,
-                    top_p=top_p,
-                    do_sample=True,
-                    pad_token_id=self._tokenizer.pad_token_id,
-                    eos_token_id=self._tokenizer.eos_token_id,
-                    repetition_penalty=1.2
+                    pad_token_id=self._pad_id,
+                    eos_token_id=self._eos_id,
+                    **sampling_kwargs
                 )
             
             logger.info(f"✅ generate() завершен, длина вывода: {outputs.shape}")
             
+            # Декодируем только сгенерированные токены (промпт в ответ не попадает)
             generated_text = self._tokenizer.decode(
-                outputs[0],
+                outputs[0][input_ids.shape[1]:],
                 skip_special_tokens=True
             )
             
-            # Убираем промпт из ответа
-            if generated_text.startswith(prompt):
-                generated_text = generated_text[len(prompt):].strip()
+            if logits_processor is not None:
+                # Декодирование было ограничено схемой - это и есть JSON
+                return generated_text.strip()
             
             # Убираем "думающий" режим Qwen3 (теги <think>)
-            import re
-            generated_text = re.sub(r'<think>.*?</think>', '', generated_text, flags=re.DOTALL)
-            generated_text = re.sub(r'<\|.*?\|>', '', generated_text)  # Убираем спец. токены
+            generated_text = _THINK_RE.sub('', generated_text)
+            generated_text = _SPECIAL_RE.sub('', generated_text)  # Убираем спец. токены
             
             # Берем только первый абзац если есть повторения
             lines = generated_text.strip().split('\n')
@@ -681,26 +998,32 @@ class QwenService:
     
     def _fallback_classify(self, text: str, filename: str) -> Dict[str, Any]:
         """Fallback classification based on keywords"""
-        text_lower = text.lower()
-        filename_lower = filename.lower()
+        # Признаки типа и приоритета почти всегда в заголовке: не копируем и не сканируем весь документ
+        text_lower = text[:_FALLBACK_SCAN_CHARS].lower()
         
-        doc_type = "scan"
-        if any(word in text_lower for word in ["договор", "контракт", "соглашение"]):
-            doc_type = "contract"
-        elif any(word in text_lower for word in ["счет", "invoice", "счет-фактура"]):
-            doc_type = "invoice"
-        elif any(word in text_lower for word in ["акт", "приемки", "выполнения"]):
-            doc_type = "act"
-        elif any(word in text_lower for word in ["приказ", "распоряжение", "order"]):
-            doc_type = "order"
-        elif any(word in text_lower for word in ["письмо", "email", "сообщение"]):
-            doc_type = "email"
-        
-        priority = "medium"
-        if any(word in text_lower for word in ["срочно", "urgent", "важно", "important"]):
-            priority = "high"
-        elif any(word in text_lower for word in ["низкий", "low", "неважно"]):
-            priority = "low"
+        if _KEYWORD_AUTOMATON is not None:
+            # Один проход автомата по тексту: собираем найденные категории,
+            # затем выбираем по приоритету (как раньше при последовательных проверках)
+            found_types = set()
+            found_priorities = set()
+            for _, (category, label) in _KEYWORD_AUTOMATON.iter(text_lower):
+                if category == "type":
+                    found_types.add(label)
+                else:
+                    found_priorities.add(label)
+                # Старшие категории уже найдены - дальше сканировать незачем
+                if _DOC_TYPE_ORDER[0] in found_types and _PRIORITY_ORDER[0] in found_priorities:
+                    break
+            
+            doc_type = next((label for label in _DOC_TYPE_ORDER if label in found_types), "scan")
+            priority = next((label for label in _PRIORITY_ORDER if label in found_priorities), "medium")
+        else:
+            doc_type = next(
+                (label for label, pattern in _DOC_TYPE_PATTERNS.items() if pattern.search(text_lower)), "scan"
+            )
+            priority = next(
+                (label for label, pattern in _PRIORITY_PATTERNS.items() if pattern.search(text_lower)), "medium"
+            )
         
         # Извлекаем простые теги из текста и названия файла
         from pathlib import Path
@@ -1,101 +1,801 @@
+import asyncio
+import hashlib
 import logging
-import json
+import os
+import orjson
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import List, Dict, Optional
 import numpy as np
 import torch
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, text
 from app.core.config import settings
-from app.models.vector_store import DocumentChunk
+from app.core.redis_client import get_redis_binary
 from app.models.document import Document
 from app.services.qwen_service import QwenService
+from app.services.document_processor import DocumentProcessor
+from app.services.embedding_service import EmbeddingService
+from app.services.embedding_cache import EmbeddingCache
 
 logger = logging.getLogger(__name__)
 
+# Значение RAG_EMBEDDING_MODEL, при котором эмбеддинги строятся на Qwen3-4B
+QWEN_EMBEDDING_MODEL = "qwen3-4b"
+# Размер части батча при параллельном кодировании чанков на CPU
+_CPU_SUB_BATCH = 32
+# Пробный forward для оценки памяти активаций на токен и доля свободной VRAM под батч
+_MEMORY_PROBE_TOKENS = 512
+_VRAM_BUDGET_FRACTION = 0.8
+# Поток подготовки (паддинга) следующего батча Qwen-эмбеддингов, пока идет forward текущего
+_PAD_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed-pad")
+# Единственный поток вызовов модели эмбеддингов из async кода: forward выполняются по одному,
+# не конкурируя за GPU и VRAM (бюджет токенов _cuda_token_budget рассчитан на один батч)
+_MODEL_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed-model")
+
+
+# SQL запросы собираются один раз: текст стабилен (top_k и фильтры - параметры),
+# поэтому asyncpg переиспользует подготовленный запрос на соединении вместо разбора и планирования
+INSERT_CHUNK_SQL = text("""
+    INSERT INTO document_chunks 
+    (id, document_id, chunk_id, text, start_pos, end_pos, embedding, chunk_metadata)
+    VALUES 
+    (:id, :document_id, :chunk_id, :text, :start_pos, :end_pos, CAST(:embedding AS halfvec), :chunk_metadata)
+""")
+# Столбцы бинарного COPY (порядок значений в записях) и порог, с которого COPY выгоднее executemany
+_CHUNK_COLUMNS = ["id", "document_id", "chunk_id", "text", "start_pos", "end_pos", "embedding", "chunk_metadata"]
+_COPY_MIN_ROWS = 64
+
+# Сортировка по самому оператору расстояния позволяет использовать HNSW индекс. Postgres только
+# отбирает кандидатов (:candidates); точный cosine и финальный top_k считаются в NumPy (_rerank_by_cosine)
+SEARCH_FOR_QWEN_SQL = text("""
+    SELECT 
+        dc.id,
+        dc.document_id,
+        dc.chunk_id,
+        dc.text,
+        dc.start_pos,
+        dc.end_pos,
+        dc.chunk_metadata,
+        d.title as document_title,
+        d.type as document_type,
+        d.path as document_path,
+        dc.embedding
+    FROM document_chunks dc
+    JOIN documents d ON dc.document_id = d.id
+    WHERE d.is_deleted = false
+    ORDER BY dc.embedding <=> CAST(:embedding AS halfvec)
+    LIMIT :candidates
+""")
+
+_SEARCH_SIMILAR_SELECT = """
+    SELECT 
+        dc.id,
+        dc.document_id,
+        dc.chunk_id,
+        dc.text,
+        dc.start_pos,
+        dc.end_pos,
+        dc.chunk_metadata,
+        d.title as document_title,
+        d.type as document_type,
+        dc.embedding
+    FROM document_chunks dc
+    JOIN documents d ON dc.document_id = d.id
+    WHERE d.is_deleted = false
+"""
+_SEARCH_SIMILAR_ORDER = """
+    ORDER BY dc.embedding <=> CAST(:embedding AS halfvec)
+    LIMIT :candidates
+"""
+_HALFVEC_ORDER = "ORDER BY dc.embedding <=> CAST(:embedding AS halfvec)"
+# Порядок по Хэммингу бинарно квантованных эмбеддингов - то же выражение, что в индексе
+# EMBEDDING_BINARY_INDEX_SQL (размерность bit(N) должна совпадать)
+_BINARY_ORDER = "ORDER BY binary_quantize(dc.embedding)::bit({dim}) <~> binary_quantize(CAST(:embedding AS halfvec))"
+# Ширина поиска HNSW в пределах текущей транзакции (SET LOCAL с параметром); pgvector
+# отвергает hnsw.ef_search больше _MAX_EF_SEARCH
+_MAX_EF_SEARCH = 1000
+SET_EF_SEARCH_SQL = text("SELECT set_config('hnsw.ef_search', :ef_search, true)")
+
+# Два варианта вместо условного фильтра: у каждого свой стабильный план
+SEARCH_SIMILAR_SQL = text(_SEARCH_SIMILAR_SELECT + _SEARCH_SIMILAR_ORDER)
+SEARCH_SIMILAR_IN_DOCUMENTS_SQL = text(
+    _SEARCH_SIMILAR_SELECT
+    + "    AND dc.document_id = ANY(CAST(:document_ids AS uuid[]))\n"
+    + _SEARCH_SIMILAR_ORDER
+)
+
+
+@lru_cache(maxsize=None)
+def _binary_prefilter_sql(sql: str, dim: int):
+    """Вариант поискового запроса с отбором кандидатов по Хэммингу (RAG_BINARY_PREFILTER)"""
+    return text(sql.replace(_HALFVEC_ORDER, _BINARY_ORDER.format(dim=dim)))
+
+
+def _search_sql(sql, query_embedding: np.ndarray):
+    """Поисковый запрос для текущего режима отбора кандидатов"""
+    if not settings.RAG_BINARY_PREFILTER:
+        return sql
+    return _binary_prefilter_sql(sql.text, query_embedding.shape[0])
+
+
+def _candidates_factor() -> int:
+    """Кандидатов на top_k: бинарному отбору нужен больший запас перед точным cosine"""
+    if settings.RAG_BINARY_PREFILTER:
+        return settings.RAG_BINARY_CANDIDATES_FACTOR
+    return settings.RAG_RERANK_CANDIDATES_FACTOR
+
+
+async def _run_in_model_thread(func, *args):
+    """Вызов модели эмбеддингов в потоке _MODEL_EXECUTOR, event loop не блокируется"""
+    return await asyncio.get_running_loop().run_in_executor(_MODEL_EXECUTOR, func, *args)
+
+
+def _embedding_to_numpy(value) -> np.ndarray:
+    """halfvec из Postgres: HalfVector (бинарный кодек pgvector) или текст '[...]' без кодека"""
+    if hasattr(value, "to_numpy"):
+        return value.to_numpy()
+    return np.asarray(orjson.loads(value), dtype=np.float32)
+
+
+def _rerank_by_cosine(rows, query_embedding: np.ndarray, top_k: int) -> List[tuple]:
+    """
+    Точное cosine-ранжирование кандидатов, отобранных HNSW индексом: одно умножение матрицы
+    [K, D] на нормализованный запрос. Эмбеддинг - последний столбец строки
+    Returns: [(строка без эмбеддинга, similarity)] по убыванию similarity, не более top_k
+    """
+    if not rows:
+        return []
+    matrix = np.stack([_embedding_to_numpy(row[-1]) for row in rows]).astype(np.float32)
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1.0
+    sims = (matrix @ query_embedding) / norms
+    order = np.argsort(-sims, kind="stable")[:top_k]
+    return [(rows[i][:-1], float(sims[i])) for i in order]
+
+
+def _normalize_query(query: str) -> str:
+    """Ключ кэша эмбеддингов запросов: нижний регистр, схлопнутые пробелы"""
+    return " ".join(query.lower().split())
+
+
+def _default_batch_size(device: str, n_texts: int) -> int:
+    """Размер батча эмбеддингов по устройству и объему VRAM (верхняя граница для _plan_batches)"""
+    if device == "cuda" and torch.cuda.is_available():
+        # Определяем размер VRAM для выбора оптимального batch_size
+        try:
+            vram_gb = torch.cuda.get_device_properties(0).total_memory / (1024**3)
+            if vram_gb >= 40:
+                # A100/H100: большие батчи
+                return min(128, max(32, n_texts // 5))
+            elif vram_gb >= 16:
+                # RTX 3090/4090: средние батчи
+                return min(32, max(8, n_texts // 10))
+            elif vram_gb >= 8:
+                # RTX 3060/3070: малые батчи
+                return min(16, max(4, n_texts // 15))
+            else:
+                # RTX 2050/2060 (4GB): очень малые батчи
+                return min(4, max(2, n_texts // 20))
+        except Exception:
+            # Fallback для RTX 2050 (4GB)
+            return min(4, max(2, n_texts // 20))
+    elif device == "mps":
+        # MPS (Apple Silicon) - меньшие батчи
+        return min(16, max(4, n_texts // 10))
+    else:
+        # CPU - еще меньшие батчи
+        return min(8, max(2, n_texts // 20))
+
+
+def _plan_batches(
+    order: List[int],
+    lengths: List[int],
+    max_batch_size: int,
+    token_budget: Optional[int]
+) -> List[List[int]]:
+    """
+    Разбить индексы (отсортированные по длине) на батчи не больше max_batch_size,
+    у которых batch * max_len не превышает token_budget (None - без ограничения)
+    """
+    batches = []
+    current: List[int] = []
+    for idx in order:
+        # Длины возрастают, поэтому длина текущего текста - максимум в батче
+        fits_budget = token_budget is None or (len(current) + 1) * lengths[idx] <= token_budget
+        if current and (len(current) >= max_batch_size or not fits_budget):
+            batches.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _masked_mean_pool(hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    """
+    Mean pooling по токенам без паддинга
+    Маска транслируется по hidden (без expand и fp32-копии [B, L, H]), сумма накапливается в fp32
+    Returns: [B, H] float32
+    """
+    if hidden_states.dtype == torch.float32:
+        # fp32 (CPU): сумма по токенам одним batched matmul [B, 1, L] x [B, L, H] -
+        # без временного [B, L, H] и в несколько потоков BLAS
+        summed = torch.bmm(attention_mask.unsqueeze(1).to(hidden_states.dtype), hidden_states).squeeze(1)
+    else:
+        # fp16/bf16: результат bmm остался бы в половинной точности (переполнение суммы) - маскирование
+        mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+        summed = (hidden_states * mask).sum(dim=1, dtype=torch.float32)
+    counts = attention_mask.sum(dim=1, keepdim=True, dtype=torch.float32).clamp_min(1e-9)
+    return summed / counts
+
+
+def _pool_embeddings(
+    hidden_states: torch.Tensor,
+    attention_mask: torch.Tensor,
+    projection: Optional[tuple] = None
+) -> torch.Tensor:
+    """
+    Эмбеддинги батча из скрытых состояний: mean pooling, L2-нормализация, PCA-проекция (если задана)
+    и повторная L2-нормализация
+    Returns: [B, D] float32
+    """
+    embeddings = torch.nn.functional.normalize(_masked_mean_pool(hidden_states, attention_mask), p=2, dim=1)
+    if projection is not None:
+        # PCA обучена на нормализованных полных эмбеддингах (fit_embedding_pca.py) -
+        # проекция применяется к тому же распределению: одно умножение [B, H] x [H, dim]
+        mean, components = projection
+        embeddings = torch.nn.functional.normalize((embeddings - mean) @ components, p=2, dim=1)
+    return embeddings
+
+
+_compiled_pool_embeddings = None  # torch.compile(_pool_embeddings); False - компиляция недоступна
+
+
+def _pool_embeddings_fused(
+    hidden_states: torch.Tensor,
+    attention_mask: torch.Tensor,
+    projection: Optional[tuple] = None
+) -> torch.Tensor:
+    """
+    _pool_embeddings, на CUDA при RAG_TORCH_COMPILE_POOLING - через torch.compile: маскирование,
+    суммы, деление и нормализация сливаются в пару ядер вместо запуска каждого отдельно
+    dynamic=True - одна компиляция на любые длины батча и последовательности; при ошибке - eager
+    """
+    global _compiled_pool_embeddings
+    if (
+        not settings.RAG_TORCH_COMPILE_POOLING
+        or hidden_states.device.type != "cuda"
+        or _compiled_pool_embeddings is False
+    ):
+        return _pool_embeddings(hidden_states, attention_mask, projection)
+    
+    if _compiled_pool_embeddings is None:
+        _compiled_pool_embeddings = torch.compile(_pool_embeddings, dynamic=True, fullgraph=True)
+    try:
+        return _compiled_pool_embeddings(hidden_states, attention_mask, projection)
+    except Exception as e:
+        logger.warning(f"⚠️ torch.compile пулинга недоступен ({e}), используется eager режим")
+        _compiled_pool_embeddings = False
+        return _pool_embeddings(hidden_states, attention_mask, projection)
+
+
+def _last_hidden_state(model, inputs: Dict[str, torch.Tensor]) -> torch.Tensor:
+    """
+    Последний скрытый слой Qwen (после финальной нормализации, как outputs.hidden_states[-1])
+    Вызывается базовая модель без LM-головы: не считаются логиты по словарю
+    и не сохраняются скрытые состояния всех слоев (output_hidden_states=True)
+    ONNX Runtime модель (feature-extraction) уже возвращает last_hidden_state
+    """
+    if not isinstance(model, torch.nn.Module):
+        return model(**inputs).last_hidden_state
+    return model.base_model(**inputs, use_cache=False).last_hidden_state
+
+
+class SemanticQueryCache:
+    """
+    Кэш результатов поиска по близости эмбеддингов запросов
+    Если новый запрос имеет cosine >= threshold к закэшированному - возвращаем его результат
+    без обращения к Postgres. Эмбеддинги L2-нормализованы, поэтому cosine = скалярное произведение
+    (одно умножение матрицы на вектор). Вытеснение FIFO.
+    """
+    
+    def __init__(self, capacity: int, threshold: float, ttl_seconds: float):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self._matrix: Optional[np.ndarray] = None  # [capacity, D] float32
+        self._entries: List[tuple] = []  # (top_k, chunks, created_at)
+        self._next = 0
+        self._lock = threading.Lock()
+    
+    def get(self, query_embedding: np.ndarray, top_k: int) -> Optional[List[Dict]]:
+        with self._lock:
+            if not self._entries or self._matrix.shape[1] != query_embedding.shape[0]:
+                return None
+            
+            sims = self._matrix[:len(self._entries)] @ query_embedding
+            idx = int(np.argmax(sims))
+            if sims[idx] < self.threshold:
+                return None
+            
+            cached_top_k, chunks, created_at = self._entries[idx]
+            if cached_top_k < top_k or time.monotonic() - created_at > self.ttl_seconds:
+                return None
+            return chunks[:top_k]
+    
+    def put(self, query_embedding: np.ndarray, top_k: int, chunks: List[Dict]):
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != query_embedding.shape[0]:
+                self._matrix = np.zeros((self.capacity, query_embedding.shape[0]), dtype=np.float32)
+                self._entries = []
+                self._next = 0
+            
+            entry = (top_k, chunks, time.monotonic())
+            self._matrix[self._next] = query_embedding
+            if self._next < len(self._entries):
+                self._entries[self._next] = entry
+            else:
+                self._entries.append(entry)
+            self._next = (self._next + 1) % self.capacity
+    
+    def clear(self):
+        with self._lock:
+            self._entries = []
+            self._next = 0
+
+
+class DynamicEmbeddingBatcher:
+    """
+    Динамический батчинг эмбеддингов для конкурентных запросов
+    Запросы копятся в очереди до max_batch текстов или max_delay_ms и кодируются одним вызовом
+    модели в отдельном потоке: один forward на батч вместо forward на каждый запрос,
+    event loop не блокируется
+    
+    Очередь и воркер у каждого event loop свои: временные loop в потоках (фоновые задачи
+    без Celery) не делят очередь с основным. Воркер завершается, когда очередь пуста,
+    и не остается висеть на закрытом loop
+    """
+    
+    def __init__(self, encode_batch, max_batch: int, max_delay_ms: float):
+        self._encode_batch = encode_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._workers: Dict[asyncio.AbstractEventLoop, tuple] = {}  # loop -> (очередь, задача воркера)
+    
+    async def embed(self, text: str) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        worker = self._workers.get(loop)
+        if worker is None:
+            queue = asyncio.Queue()
+            self._workers[loop] = worker = (queue, loop.create_task(self._batch_worker(queue)))
+        
+        future = loop.create_future()
+        worker[0].put_nowait((text, future))
+        return await future
+    
+    async def embed_many(self, texts: List[str]) -> List[np.ndarray]:
+        """Эмбеддинги списка текстов через общую очередь (в порядке texts)"""
+        return list(await asyncio.gather(*(self.embed(text) for text in texts)))
+    
+    async def _batch_worker(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        try:
+            # Проверка пустоты и выход без await между ними: embed() того же loop
+            # не может положить текст в очередь уже завершающегося воркера
+            while not queue.empty():
+                batch = [queue.get_nowait()]
+                deadline = loop.time() + self.max_delay
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                
+                try:
+                    embeddings = await _run_in_model_thread(self._encode_batch, [text for text, _ in batch])
+                except Exception as e:
+                    if len(batch) == 1:
+                        if not batch[0][1].done():
+                            batch[0][1].set_exception(e)
+                        continue
+                    # Ошибка одного текста (например, слишком длинного) не должна ронять запросы
+                    # других документов из того же окна: каждый текст кодируется заново отдельно
+                    logger.warning(f"⚠️ Ошибка батча эмбеддингов из {len(batch)} текстов ({e}), кодирую по одному")
+                    await self._encode_each(batch)
+                    continue
+                
+                for (_, future), embedding in zip(batch, embeddings):
+                    if not future.done():
+                        future.set_result(embedding)
+        finally:
+            self._workers.pop(loop, None)
+    
+    async def _encode_each(self, batch):
+        """Закодировать тексты окна по одному: исключение получает только future своего текста"""
+        for text, future in batch:
+            if future.done():
+                continue
+            try:
+                embedding = (await _run_in_model_thread(self._encode_batch, [text]))[0]
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(embedding)
+
 
 class RAGService:
-    """Service for RAG operations using Qwen3-4B for embeddings"""
+    """Service for RAG operations using Qwen3-4B (or SentenceTransformer) for embeddings"""
     
-    _instance = None
     _qwen_service = None
-    
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(RAGService, cls).__new__(cls)
-        return cls._instance
+    _qwen_lock = threading.Lock()  # Одна загрузка Qwen при конкурентных первых запросах
+    _embed_model = None  # Qwen для эмбеддингов: общие веса или постоянная CPU-копия (см. _get_embed_model)
+    _embed_device = None
+    _cuda_bytes_per_token = None  # Измеренная память активаций на токен (см. _cuda_token_budget)
+    _embedding_service = EmbeddingService()  # Компактный sentence encoder, если выбран вместо Qwen
+    _projection = None  # PCA-проекция Qwen-эмбеддингов (mean, components) на устройстве модели
+    _embedding_space = None  # Идентификатор пространства эмбеддингов (embedding_space_id)
+    _query_model = None  # Model2Vec для эмбеддингов запросов (RAG_QUERY_BACKEND="model2vec"); False - недоступен
+    _search_cache = SemanticQueryCache(
+        capacity=max(1, settings.RAG_SEMANTIC_CACHE_SIZE),
+        threshold=settings.RAG_SEMANTIC_CACHE_THRESHOLD,
+        ttl_seconds=settings.RAG_SEMANTIC_CACHE_TTL
+    )
     
     def __init__(self):
         # Lazy loading - Qwen модель будет загружена при первом использовании
         # Это предотвращает блокировку при старте приложения
-        pass
+        # Используйте модульный экземпляр rag_service - состояние (кэши, очередь батчинга) общее
+        # Накопленное окно кодируется одним батчем: одна токенизация и один forward
+        # Поисковые запросы и чанки документов - разные батчеры (разные префиксы модели)
+        self._batcher = DynamicEmbeddingBatcher(
+            lambda texts: self.generate_embeddings_batch(texts, batch_size=len(texts), is_query=True),
+            max_batch=settings.RAG_DYNAMIC_BATCH_SIZE,
+            max_delay_ms=settings.RAG_DYNAMIC_BATCH_DELAY_MS
+        )
+        # Чанки конкурентно обрабатываемых документов (загрузки, reprocess_documents) объединяются
+        # в общие батчи: мелкие документы не платят за отдельный вызов модели каждый
+        self._passage_batcher = DynamicEmbeddingBatcher(
+            self.generate_embeddings_batch,
+            max_batch=settings.RAG_PASSAGE_BATCH_SIZE,
+            max_delay_ms=settings.RAG_PASSAGE_BATCH_DELAY_MS
+        )
+        self._query_embeddings = EmbeddingCache(
+            max_size=settings.RAG_QUERY_EMBEDDING_CACHE_SIZE,
+            ttl_seconds=settings.RAG_QUERY_EMBEDDING_CACHE_TTL
+        )
+        self._doc_processor = DocumentProcessor()
+        self._pinned_local = threading.local()  # Pinned-буферы входов для GPU (_to_device_pinned)
     
     def _ensure_qwen_loaded(self):
         """Ensure Qwen model is loaded (lazy loading)"""
-        if self._qwen_service is None:
-            self._qwen_service = QwenService()
-            # Убеждаемся, что модель загружена
-            self._qwen_service._ensure_model_loaded()
+        if self._qwen_service is not None:
+            return
+        with self._qwen_lock:
+            if self._qwen_service is None:
+                qwen_service = QwenService()
+                # Убеждаемся, что модель загружена
+                qwen_service._ensure_model_loaded()
+                self._qwen_service = qwen_service
     
-    def generate_embedding(self, text: str) -> np.ndarray:
+    def _get_embed_model(self):
         """
-        Generate embedding for text using Qwen3-4B model
-        Использует скрытые состояния модели для создания эмбеддингов
+        Модель Qwen для эмбеддингов и ее устройство
+        CUDA/CPU: те же веса, что и для генерации. MPS: отдельная read-only копия на CPU
+        создается один раз (на MPS forward для эмбеддингов нестабилен), GPU-копия не трогается
         """
         self._ensure_qwen_loaded()
-        
-        try:
+        if self._embed_model is None:
             model = self._qwen_service._model
-            tokenizer = self._qwen_service._tokenizer
-            
-            if model is None or tokenizer is None:
+            if model is None:
                 raise RuntimeError("Qwen model not loaded")
-            
-            # Токенизация текста
-            inputs = tokenizer(
-                text,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=2048
+            device = self._qwen_service._device
+            onnx_model = None
+            if settings.RAG_QWEN_ONNX_CPU and device is not None and torch.device(device).type != "cuda":
+                onnx_model = self._load_qwen_onnx()
+            if onnx_model is not None:
+                self._embed_model = onnx_model
+                self._embed_device = torch.device("cpu")
+            elif device is not None and torch.device(device).type == "mps":
+                import copy
+                logger.info("📥 Создаю CPU-копию Qwen для эмбеддингов (MPS)...")
+                self._embed_model = copy.deepcopy(model).to("cpu").eval()
+                # Копия только для эмбеддингов: KV-кэш не нужен
+                self._embed_model.config.use_cache = False
+                self._embed_device = torch.device("cpu")
+            else:
+                self._embed_model = model
+                self._embed_device = device
+        return self._embed_model, self._embed_device
+    
+    def _load_qwen_onnx(self):
+        """
+        Qwen для эмбеддингов на CPU через ONNX Runtime (optimum): фьюзинг MatMul/LayerNorm и GEMM oneDNN
+        вместо PyTorch eager. Экспорт выполняется один раз в RAG_EMBEDDING_CACHE_DIR/qwen-onnx
+        Returns: ORTModelForFeatureExtraction или None (optimum не установлен / экспорт не удался)
+        """
+        try:
+            import onnxruntime as ort
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+        except ImportError:
+            logger.warning("⚠️ optimum[onnxruntime] не установлен, эмбеддинги Qwen считаются в PyTorch")
+            return None
+        
+        onnx_dir = os.path.join(settings.RAG_EMBEDDING_CACHE_DIR, "qwen-onnx")
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = os.cpu_count() or 1
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        
+        try:
+            if os.path.isfile(os.path.join(onnx_dir, "model.onnx")):
+                model = ORTModelForFeatureExtraction.from_pretrained(onnx_dir, session_options=session_options)
+            else:
+                logger.info("📥 Экспорт Qwen в ONNX для эмбеддингов на CPU (однократно)...")
+                model = ORTModelForFeatureExtraction.from_pretrained(
+                    self._qwen_service._model.name_or_path,
+                    export=True,
+                    session_options=session_options
+                )
+                model.save_pretrained(onnx_dir)
+            logger.info("✅ Эмбеддинги Qwen на CPU считаются через ONNX Runtime")
+            return model
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось загрузить Qwen в ONNX Runtime ({e}), эмбеддинги считаются в PyTorch")
+            return None
+    
+    def _to_device_pinned(self, inputs: Dict[str, torch.Tensor], device) -> Dict[str, torch.Tensor]:
+        """
+        Перенос input_ids/attention_mask на GPU через переиспользуемый pinned-буфер:
+        одна асинхронная копия вместо двух синхронных из pageable памяти и без pin на каждый батч
+        Буфер свой у каждого потока (эмбеддинги считаются из нескольких потоков)
+        """
+        input_ids = inputs["input_ids"]
+        batch, length = input_ids.shape
+        size = 2 * batch * length
+        
+        pinned = getattr(self._pinned_local, "buffer", None)
+        if pinned is None or pinned.numel() < size:
+            pinned = torch.empty(max(size, 2 * 32 * 2048), dtype=torch.long, pin_memory=True)
+            self._pinned_local.buffer = pinned
+        
+        staged = pinned[:size].view(2, batch, length)
+        staged[0].copy_(input_ids)
+        staged[1].copy_(inputs["attention_mask"])
+        on_device = staged.to(device, non_blocking=True)
+        return {"input_ids": on_device[0], "attention_mask": on_device[1]}
+    
+    def _cuda_token_budget(self, model, device) -> int:
+        """
+        Сколько токенов (batch_size * seq_len) помещается в свободную VRAM
+        Память активаций на токен измеряется один раз пробным forward на _MEMORY_PROBE_TOKENS токенах
+        (MEM ≈ bytes_per_token * batch * seq_len); бюджет - _VRAM_BUDGET_FRACTION свободной памяти
+        """
+        if self._cuda_bytes_per_token is None:
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            baseline = torch.cuda.memory_allocated(device)
+            probe_ids = torch.zeros((1, _MEMORY_PROBE_TOKENS), dtype=torch.long, device=device)
+            with torch.inference_mode():
+                _last_hidden_state(model, {"input_ids": probe_ids, "attention_mask": torch.ones_like(probe_ids)})
+            peak = torch.cuda.max_memory_allocated(device)
+            RAGService._cuda_bytes_per_token = max(1.0, (peak - baseline) / _MEMORY_PROBE_TOKENS)
+            logger.info(f"📏 Память активаций эмбеддингов: {self._cuda_bytes_per_token / 1024:.1f} KiB/токен")
+        
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        return max(1, int(free_bytes * _VRAM_BUDGET_FRACTION / self._cuda_bytes_per_token))
+    
+    def _use_sentence_transformer(self) -> bool:
+        """Используется ли SentenceTransformer вместо скрытых состояний Qwen"""
+        return settings.RAG_EMBEDDING_MODEL != QWEN_EMBEDDING_MODEL
+    
+    def generate_embedding(self, text: str, is_query: bool = False) -> np.ndarray:
+        """
+        Generate embedding for text (EmbeddingService или скрытые состояния Qwen3-4B)
+        Один путь кода с батчевой генерацией; из async кода используйте embed() -
+        конкурентные вызовы объединяются в один forward (DynamicEmbeddingBatcher)
+        """
+        return self.generate_embeddings_batch([text], is_query=is_query)[0]
+    
+    async def _embed_texts_async(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        Эмбеддинги чанков документа вне event loop
+        Повторяющиеся тексты (колонтитулы, типовые пункты) кодируются один раз,
+        результат раскладывается по исходным позициям
+        """
+        unique_index: Dict[str, int] = {}
+        order = [unique_index.setdefault(chunk_text, len(unique_index)) for chunk_text in texts]
+        if len(unique_index) == len(texts):
+            return await self._encode_texts_async(texts)
+        
+        logger.info(f"♻️ Дубликаты чанков: {len(texts) - len(unique_index)} из {len(texts)} не кодируются повторно")
+        unique_embeddings = await self._encode_texts_async(list(unique_index))
+        return [unique_embeddings[i] for i in order]
+    
+    async def _encode_texts_async(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        На CPU (ONNX) чанки делятся на части, которые кодируются параллельно в потоках,
+        не более RAG_CPU_ENCODE_WORKERS одновременно (без переподписки ядер)
+        """
+        if torch.cuda.is_available() or not self._use_sentence_transformer() or len(texts) <= _CPU_SUB_BATCH:
+            return await self._passage_batcher.embed_many(texts)
+        
+        await asyncio.to_thread(self._embedding_service.load)
+        semaphore = asyncio.Semaphore(settings.RAG_CPU_ENCODE_WORKERS)
+        
+        async def encode_part(part: List[str]) -> np.ndarray:
+            async with semaphore:
+                return await asyncio.to_thread(
+                    self._embedding_service.encode, part, _CPU_SUB_BATCH, settings.RAG_PASSAGE_PROMPT
+                )
+        
+        parts = await asyncio.gather(*(
+            encode_part(texts[i:i + _CPU_SUB_BATCH]) for i in range(0, len(texts), _CPU_SUB_BATCH)
+        ))
+        return [embedding for part in parts for embedding in part]
+    
+    def _document_embedding_dim(self) -> int:
+        """Размерность эмбеддингов документов (основная модель)"""
+        if self._use_sentence_transformer():
+            return self._embedding_service.dimension()
+        if settings.RAG_EMBEDDING_DIM:
+            return settings.RAG_EMBEDDING_DIM
+        self._ensure_qwen_loaded()
+        return self._qwen_service._model.config.hidden_size
+    
+    def embedding_space_id(self) -> str:
+        """
+        Идентификатор пространства эмбеддингов: модель, размерность, префиксы запросов и фрагментов
+        и содержимое PCA-проекции. Меняется при любой настройке, после которой сохраненные векторы
+        несовместимы с новыми (ключи кэша запросов в Redis, версия RAG в reprocess_documents.py)
+        """
+        if self._embedding_space is None:
+            parts = [
+                settings.RAG_EMBEDDING_MODEL,
+                str(settings.RAG_EMBEDDING_DIM),
+                settings.RAG_QUERY_PROMPT,
+                settings.RAG_PASSAGE_PROMPT
+            ]
+            path = settings.RAG_EMBEDDING_PCA_PATH
+            if settings.RAG_EMBEDDING_MODEL == QWEN_EMBEDDING_MODEL and settings.RAG_EMBEDDING_DIM and os.path.isfile(path):
+                with open(path, "rb") as f:
+                    parts.append(hashlib.sha256(f.read()).hexdigest())
+            RAGService._embedding_space = hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+        return self._embedding_space
+    
+    def _get_projection(self, device: torch.device):
+        """
+        PCA-проекция скрытых состояний Qwen (hidden_size -> RAG_EMBEDDING_DIM)
+        Матрица обучается один раз скриптом fit_embedding_pca.py; None - без проекции
+        """
+        if not settings.RAG_EMBEDDING_DIM:
+            return None
+        if self._projection is None:
+            path = settings.RAG_EMBEDDING_PCA_PATH
+            if not os.path.isfile(path):
+                raise RuntimeError(
+                    f"PCA-проекция не найдена: {path}. Запустите fit_embedding_pca.py "
+                    f"или установите RAG_EMBEDDING_DIM=0"
+                )
+            data = np.load(path)
+            mean = torch.from_numpy(data["mean"].astype(np.float32)).to(device)
+            components = torch.from_numpy(data["components"].astype(np.float32)).to(device)  # [hidden_size, dim]
+            if components.shape[1] != settings.RAG_EMBEDDING_DIM:
+                raise RuntimeError(
+                    f"PCA-проекция {path} на {components.shape[1]} измерений, "
+                    f"RAG_EMBEDDING_DIM={settings.RAG_EMBEDDING_DIM}"
+                )
+            RAGService._projection = (mean, components)
+            logger.info(f"✅ PCA-проекция эмбеддингов загружена: {components.shape[0]} -> {components.shape[1]}")
+        return self._projection
+    
+    def _get_query_model(self):
+        """
+        Model2Vec (статические эмбеддинги, без transformer слоев) для запросов, если включен
+        Корпус должен быть проиндексирован моделью той же размерности - иначе используется основная модель
+        """
+        if settings.RAG_QUERY_BACKEND != "model2vec" or self._query_model is False:
+            return None
+        if self._query_model is not None:
+            return self._query_model
+        
+        try:
+            from model2vec import StaticModel
+            query_model = StaticModel.from_pretrained(settings.RAG_QUERY_MODEL2VEC_MODEL)
+            document_dim = self._document_embedding_dim()
+            if query_model.dim != document_dim:
+                logger.warning(
+                    f"⚠️ Model2Vec ({query_model.dim}) и эмбеддинги документов ({document_dim}) "
+                    f"имеют разную размерность, запросы кодируются основной моделью"
+                )
+                self._query_model = False
+                return None
+            self._query_model = query_model
+            logger.info(f"✅ Model2Vec для запросов загружен: {settings.RAG_QUERY_MODEL2VEC_MODEL}")
+        except ImportError:
+            logger.warning("⚠️ model2vec не установлен, запросы кодируются основной моделью")
+            self._query_model = False
+        return self._query_model or None
+    
+    def _encode_query_model2vec(self, text: str) -> np.ndarray:
+        """Эмбеддинг запроса через Model2Vec (L2-нормализованный, float32)"""
+        embedding = self._query_model.encode([text])[0].astype(np.float32)
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding /= norm
+        return embedding
+    
+    async def embed(self, text: str) -> np.ndarray:
+        """Эмбеддинг из async кода через динамический батчинг (см. DynamicEmbeddingBatcher)"""
+        return await self._batcher.embed(text)
+    
+    async def _embed_query_cached(self, text: str) -> np.ndarray:
+        """
+        Эмбеддинг поискового запроса с кэшем по нормализованному тексту (регистр и пробелы не важны):
+        локальный LRU, затем общий для процессов Redis (RAG_QUERY_EMBEDDING_REDIS_TTL), затем модель
+        Массив возвращается только для чтения, т.к. разделяется между вызовами
+        """
+        normalized = _normalize_query(text)
+        key = EmbeddingCache.make_key(normalized)
+        embedding = self._query_embeddings.get(key)
+        if embedding is not None:
+            return embedding
+        
+        query_backend = "model2vec" if self._get_query_model() is not None else settings.RAG_EMBEDDING_MODEL
+        # Пространство эмбеддингов в ключе: после смены размерности, префикса или проекции общий
+        # Redis не отдает векторы, несовместимые с перестроенным столбцом halfvec
+        space = (
+            settings.RAG_QUERY_MODEL2VEC_MODEL.replace(":", "_") if query_backend == "model2vec"
+            else self.embedding_space_id()
+        )
+        redis_key = f"query_embedding:{query_backend}:{space}:{key}"
+        embedding = await self._get_query_embedding_from_redis(redis_key)
+        if embedding is None:
+            if query_backend == "model2vec":
+                embedding = self._encode_query_model2vec(normalized)
+            else:
+                embedding = await self.embed(normalized)
+            await self._save_query_embedding_to_redis(redis_key, embedding)
+        
+        return self._query_embeddings.put(key, embedding)
+    
+    def cache_stats(self) -> Dict[str, Dict[str, float]]:
+        """Счетчики кэша эмбеддингов запросов (для /metrics)"""
+        return {"query_embeddings": self._query_embeddings.stats()}
+    
+    async def _get_query_embedding_from_redis(self, redis_key: str) -> Optional[np.ndarray]:
+        """Эмбеддинг запроса из Redis (сырые байты float32) или None"""
+        if settings.RAG_QUERY_EMBEDDING_REDIS_TTL <= 0:
+            return None
+        try:
+            redis = await get_redis_binary()
+            data = await redis.get(redis_key)
+        except Exception as e:
+            logger.warning(f"⚠️ Кэш эмбеддингов запросов в Redis недоступен: {e}")
+            return None
+        if data is None:
+            return None
+        return np.frombuffer(data, dtype=np.float32).copy()
+    
+    async def _save_query_embedding_to_redis(self, redis_key: str, embedding: np.ndarray):
+        if settings.RAG_QUERY_EMBEDDING_REDIS_TTL <= 0:
+            return
+        try:
+            redis = await get_redis_binary()
+            await redis.set(
+                redis_key,
+                np.ascontiguousarray(embedding, dtype=np.float32).tobytes(),
+                ex=settings.RAG_QUERY_EMBEDDING_REDIS_TTL
             )
-            
-            device = next(model.parameters()).device
-            logger.info(f"🔄 Генерация эмбеддинга на устройстве: {device}")
-            
-            # Используем то же устройство что и модель (GPU или CPU)
-            inputs_device = {k: v.to(device) for k, v in inputs.items()}
-            
-            # Получаем скрытые состояния модели на том же устройстве
-            logger.info(f"🔄 Начинаю forward pass для эмбеддинга...")
-            with torch.no_grad():
-                outputs = model(**inputs_device, output_hidden_states=True)
-                logger.info(f"✅ Forward pass завершен")
-                
-                # Извлекаем последний скрытый слой
-                hidden_states = outputs.hidden_states[-1]
-                
-                # Mean pooling: усредняем по токенам (axis=1)
-                # Учитываем attention_mask для корректного усреднения
-                attention_mask = inputs_device["attention_mask"]
-                mask_expanded = attention_mask.unsqueeze(-1).expand(hidden_states.size()).float()
-                sum_embeddings = torch.sum(hidden_states * mask_expanded, dim=1)
-                sum_mask = torch.clamp(mask_expanded.sum(dim=1), min=1e-9)
-                embedding = (sum_embeddings / sum_mask).squeeze()
-                
-                # Перемещаем на CPU только для конвертации в numpy
-                embedding = embedding.cpu().numpy()
-                logger.info(f"✅ Эмбеддинг сгенерирован, размер: {embedding.shape}")
-            
-            # Нормализуем эмбеддинг (L2 нормализация)
-            norm = np.linalg.norm(embedding)
-            if norm > 0:
-                embedding = embedding / norm
-            
-            return embedding.astype(np.float32)
-                
         except Exception as e:
-            logger.error(f"❌ Ошибка при генерации эмбеддинга через Qwen: {e}")
-            raise
+            logger.warning(f"⚠️ Не удалось сохранить эмбеддинг запроса в Redis: {e}")
     
     async def process_document_for_metrics(
         self,
@@ -115,15 +815,8 @@ class RAGService:
         Returns:
             Метрики документа для передачи в Qwen
         """
-        # Генерируем эмбеддинги для текста
-        logger.info(f"🔄 Начинаю генерацию эмбеддинга для документа {filename}...")
-        embedding = self.generate_embedding(text)
-        logger.info(f"✅ Эмбеддинг сгенерирован для документа {filename}")
-        
         # Разбиваем на чанки для анализа
-        from app.services.document_processor import DocumentProcessor
-        processor = DocumentProcessor()
-        chunks = processor.chunk_text(text, {
+        chunks = self._doc_processor.chunk_text(text, {
             "file_name": filename,
             "file_size": file_size
         })
@@ -135,7 +828,7 @@ class RAGService:
             "file_size": file_size,
             "text_length": len(text),
             "chunks_count": len(chunks),
-            "embedding": embedding.tolist(),
+            "embedding": None,  # Заполняется в save_metrics_to_postgres из эмбеддингов чанков
             "chunks": [
                 {
                     "text": chunk["text"],
@@ -149,7 +842,12 @@ class RAGService:
         logger.info(f"✅ RAG обработал документ {filename}, подготовил метрики для Qwen")
         return metrics
     
-    def generate_embeddings_batch(self, texts: List[str], batch_size: int = None) -> List[np.ndarray]:
+    def generate_embeddings_batch(
+        self,
+        texts: List[str],
+        batch_size: int = None,
+        is_query: bool = False
+    ) -> List[np.ndarray]:
         """
         Генерирует эмбеддинги для батча текстов (оптимизировано для различных GPU)
         Автоматически определяет оптимальный batch_size в зависимости от VRAM
@@ -157,15 +855,18 @@ class RAGService:
         Args:
             texts: Список текстов для обработки
             batch_size: Размер батча (None = автоматический выбор по VRAM)
+            is_query: Поисковые запросы (префикс RAG_QUERY_PROMPT), иначе фрагменты документов
             
         Returns:
             Список эмбеддингов
         """
+        if self._use_sentence_transformer():
+            prompt = settings.RAG_QUERY_PROMPT if is_query else settings.RAG_PASSAGE_PROMPT
+            return list(self._embedding_service.encode(texts, batch_size=batch_size or 32, prompt=prompt))
+        
         self._ensure_qwen_loaded()
         
         try:
-            import torch  # Импортируем torch в начале функции
-            
             model = self._qwen_service._model
             tokenizer = self._qwen_service._tokenizer
             
@@ -176,110 +877,88 @@ class RAGService:
             
             # Автоматический выбор batch_size в зависимости от устройства
             if batch_size is None:
-                if device == "cuda" and torch.cuda.is_available():
-                    # Определяем размер VRAM для выбора оптимального batch_size
-                    try:
-                        vram_gb = torch.cuda.get_device_properties(0).total_memory / (1024**3)
-                        if vram_gb >= 40:
-                            # A100/H100: большие батчи
-                            batch_size = min(128, max(32, len(texts) // 5))
-                        elif vram_gb >= 16:
-                            # RTX 3090/4090: средние батчи
-                            batch_size = min(32, max(8, len(texts) // 10))
-                        elif vram_gb >= 8:
-                            # RTX 3060/3070: малые батчи
-                            batch_size = min(16, max(4, len(texts) // 15))
-                        else:
-                            # RTX 2050/2060 (4GB): очень малые батчи
-                            batch_size = min(4, max(2, len(texts) // 20))
-                    except Exception:
-                        # Fallback для RTX 2050 (4GB)
-                        batch_size = min(4, max(2, len(texts) // 20))
-                elif device == "mps":
-                    # MPS (Apple Silicon) - меньшие батчи
-                    batch_size = min(16, max(4, len(texts) // 10))
-                else:
-                    # CPU - еще меньшие батчи
-                    batch_size = min(8, max(2, len(texts) // 20))
+                batch_size = _default_batch_size(device, len(texts))
             
             logger.info(f"🔄 Генерирую эмбеддинги на {device} батчами по {batch_size}...")
             
-            embeddings = []
+            # Токенизируем один раз без паддинга и сортируем по длине: в батч попадают тексты
+            # близкой длины, паддинг только до максимума внутри батча, а не до самого длинного текста
+            encoded_ids = tokenizer(texts, truncation=True, max_length=2048)["input_ids"]
+            order = sorted(range(len(texts)), key=lambda idx: len(encoded_ids[idx]))
+            embeddings: List[Optional[np.ndarray]] = [None] * len(texts)
             
-            # Обрабатываем батчами
-            for i in range(0, len(texts), batch_size):
-                batch_texts = texts[i:i + batch_size]
-                
-                # Токенизация батча
-                inputs = tokenizer(
-                    batch_texts,
-                    return_tensors="pt",
-                    padding=True,
-                    truncation=True,
-                    max_length=2048
+            # На CUDA размер батча ограничен прогнозом памяти: активации растут линейно по числу
+            # токенов в батче. Прогноз не гарантия - классификация Qwen занимает ту же видеопамять
+            # параллельно, поэтому при OOM батч все равно делится пополам (embed_split)
+            token_budget = self._cuda_token_budget(model, device) if device == "cuda" else None
+            batches = _plan_batches(order, [len(ids) for ids in encoded_ids], batch_size, token_budget)
+            
+            def pad_batch(batch_indices: List[int]):
+                return tokenizer.pad(
+                    {"input_ids": [encoded_ids[idx] for idx in batch_indices]},
+                    return_tensors="pt"
                 )
+            
+            # Модель и устройство выбираются один раз: CUDA - общие веса, CPU/MPS - постоянная
+            # CPU-модель (см. _get_embed_model); дальше один путь кода для всех устройств
+            embed_model, embed_device = self._get_embed_model()
+            projection = self._get_projection(embed_device)
+            on_cuda = device == "cuda"
+            inputs = pad_batch(batches[0]) if batches else None
+            
+            def embed_inputs(batch_inputs) -> np.ndarray:
+                with torch.inference_mode():
+                    hidden_states = _last_hidden_state(embed_model, batch_inputs)  # [batch_size, seq_len, hidden_size]
+                    # Пулинг, проекция и L2-нормализация на устройстве модели
+                    batch_embeddings = _pool_embeddings_fused(
+                        hidden_states, batch_inputs["attention_mask"], projection
+                    )
+                # Одна копия всего батча на CPU (синхронизация: OOM проявляется здесь же)
+                return batch_embeddings.cpu().numpy()
+            
+            def embed_split(batch_indices: List[int]) -> np.ndarray:
+                """После CUDA OOM: половины батча считаются по очереди (рекурсивно, до одного текста)"""
+                mid = len(batch_indices) // 2
+                parts = []
+                for part in (batch_indices[:mid], batch_indices[mid:]):
+                    try:
+                        parts.append(embed_inputs(self._to_device_pinned(pad_batch(part), embed_device)))
+                    except torch.cuda.OutOfMemoryError:
+                        if len(part) == 1:
+                            raise
+                        torch.cuda.empty_cache()
+                        parts.append(embed_split(part))
+                return np.concatenate(parts)
+            
+            # Обрабатываем батчами
+            for n, batch_indices in enumerate(batches):
+                next_batch = batches[n + 1] if n + 1 < len(batches) else None
                 
-                # Используем GPU (CUDA) если доступно, иначе CPU для стабильности
-                if device == "cuda":
-                    # CUDA: используем GPU, но с учетом ограничений памяти
-                    inputs_gpu = {k: v.to(device) for k, v in inputs.items()}
-                    
-                    with torch.no_grad():
-                        # Модель уже на GPU
-                        # Для RTX 2050 (4GB) используем torch.cuda.empty_cache() если нужно
-                        try:
-                            outputs = model(**inputs_gpu, output_hidden_states=True)
-                        except torch.cuda.OutOfMemoryError:
-                            # Если не хватает памяти, очищаем кэш и пробуем меньший батч
-                            torch.cuda.empty_cache()
-                            logger.warning(f"⚠️ Недостаточно VRAM для batch_size={batch_size}, уменьшаю...")
-                            # Рекурсивно вызываем с меньшим батчем
-                            return self.generate_embeddings_batch(texts, batch_size=max(1, batch_size // 2))
-                        
-                        hidden_states = outputs.hidden_states[-1]  # [batch_size, seq_len, hidden_size]
-                        attention_mask = inputs_gpu.get('attention_mask', None)
-                        
-                        if attention_mask is not None:
-                            mask_expanded = attention_mask.unsqueeze(-1).expand(hidden_states.size()).float()
-                            sum_hidden = torch.sum(hidden_states * mask_expanded, dim=1)
-                            sum_mask = torch.clamp(mask_expanded.sum(dim=1), min=1e-9)
-                            batch_embeddings = sum_hidden / sum_mask
-                        else:
-                            batch_embeddings = torch.mean(hidden_states, dim=1)
-                        
-                        # Перемещаем на CPU для конвертации в numpy
-                        batch_embeddings = batch_embeddings.cpu()
+                if on_cuda:
+                    batch_inputs = self._to_device_pinned(inputs, embed_device)
                 else:
-                    # CPU или MPS: используем CPU для стабильности
-                    inputs_cpu = {k: v.to("cpu") for k, v in inputs.items()}
-                    
-                    with torch.no_grad():
-                        original_device = next(model.parameters()).device
-                        model_cpu = model.to("cpu")
-                        
-                        try:
-                            outputs = model_cpu(**inputs_cpu, output_hidden_states=True)
-                        finally:
-                            model.to(original_device)
-                        
-                        hidden_states = outputs.hidden_states[-1]
-                        attention_mask = inputs_cpu.get('attention_mask', None)
-                        
-                        if attention_mask is not None:
-                            mask_expanded = attention_mask.unsqueeze(-1).expand(hidden_states.size()).float()
-                            sum_hidden = torch.sum(hidden_states * mask_expanded, dim=1)
-                            sum_mask = torch.clamp(mask_expanded.sum(dim=1), min=1e-9)
-                            batch_embeddings = sum_hidden / sum_mask
-                        else:
-                            batch_embeddings = torch.mean(hidden_states, dim=1)
+                    batch_inputs = {k: v.to(embed_device) for k, v in inputs.items()}
+                
+                # Паддинг батча N+1 в отдельном потоке перекрывается с forward батча N
+                # (forward отпускает GIL); на CUDA ядра к тому же ставятся в очередь асинхронно
+                next_inputs = _PAD_EXECUTOR.submit(pad_batch, next_batch) if next_batch is not None else None
+                
+                try:
+                    batch_np = embed_inputs(batch_inputs)
+                except torch.cuda.OutOfMemoryError:
+                    if len(batch_indices) == 1:
+                        raise
+                    del batch_inputs
+                    torch.cuda.empty_cache()
+                    logger.warning(f"⚠️ CUDA OOM на батче из {len(batch_indices)} текстов, делю батч пополам")
+                    batch_np = embed_split(batch_indices)
                 
-                # Конвертируем в numpy и нормализуем
-                for emb in batch_embeddings:
-                    emb_np = emb.numpy().flatten()
-                    norm = np.linalg.norm(emb_np)
-                    if norm > 0:
-                        emb_np = emb_np / norm
-                    embeddings.append(emb_np.astype(np.float32))
+                if next_inputs is not None:
+                    inputs = next_inputs.result()
+                
+                # Строки возвращаются на исходные позиции
+                for idx, emb_np in zip(batch_indices, batch_np):
+                    embeddings[idx] = emb_np
             
             return embeddings
             
@@ -287,12 +966,41 @@ class RAGService:
             logger.error(f"❌ Ошибка при генерации эмбеддингов батчем: {e}")
             raise
     
+    async def embed_document_chunks(self, metrics: Dict[str, any]) -> np.ndarray:
+        """
+        Эмбеддинги чанков документа одним массивом [N, D] (float32), без обращения к БД
+        Заодно заполняет metrics["embedding"] - нормализованное среднее эмбеддингов чанков
+        """
+        chunk_texts = [chunk_data["text"] for chunk_data in metrics.get("chunks", [])]
+        if not chunk_texts:
+            return np.empty((0, 0), dtype=np.float32)
+        
+        # Один непрерывный массив [N, D] вместо списка векторов: одно приведение к FP16 (halfvec)
+        # для всех чанков, строки передаются кодеку pgvector как есть, без .tolist()
+        chunk_embeddings = np.asarray(await self._embed_texts_async(chunk_texts), dtype=np.float32)
+        
+        # Логируем размерность для диагностики
+        if len(chunk_embeddings):
+            emb_dim = chunk_embeddings.shape[1]
+            logger.info(f"✅ Сгенерировано {len(chunk_embeddings)} эмбеддингов, размерность: {emb_dim}")
+            # Эмбеддинг документа - нормализованное среднее эмбеддингов чанков (без отдельного forward)
+            document_embedding = np.mean(chunk_embeddings, axis=0)
+            norm = np.linalg.norm(document_embedding)
+            if norm > 0:
+                document_embedding /= norm
+            metrics["embedding"] = document_embedding.astype(np.float32)
+        else:
+            logger.warning("⚠️ Не удалось сгенерировать эмбеддинги")
+        return chunk_embeddings
+    
     async def save_metrics_to_postgres(
         self,
         db: AsyncSession,
         document_id: str,
         metrics: Dict[str, any],
-        classification_result: Dict[str, any]
+        classification_result: Dict[str, any],
+        commit: bool = True,
+        chunk_embeddings: Optional[np.ndarray] = None
     ):
         """
         Сохранить обратные метрики от Qwen в Postgres
@@ -303,77 +1011,55 @@ class RAGService:
             document_id: ID документа
             metrics: Исходные метрики
             classification_result: Результат классификации от Qwen
+            commit: False - запись в транзакции вызывающего кода (commit и rollback - на его стороне)
+            chunk_embeddings: Заранее посчитанные embed_document_chunks эмбеддинги - модель не
+                вызывается, пока транзакция вызывающего кода держит блокировки
         """
         try:
             # Сохраняем чанки с эмбеддингами
             chunks = metrics.get("chunks", [])
-            embedding = metrics.get("embedding")
-            
-            from app.models.vector_store import DocumentChunk
-            import uuid
             
             if not chunks:
                 logger.warning(f"Нет чанков для сохранения документа {document_id}")
                 return
             
             # Оптимизация: генерируем эмбеддинги батчами
-            chunk_texts = [chunk_data["text"] for chunk_data in chunks]
-            
-            # Автоматический выбор batch_size
-            chunk_embeddings = self.generate_embeddings_batch(chunk_texts, batch_size=None)
-            
-            # Логируем размерность для диагностики
-            if chunk_embeddings:
-                emb_dim = len(chunk_embeddings[0]) if hasattr(chunk_embeddings[0], '__len__') else chunk_embeddings[0].shape[0]
-                logger.info(f"✅ Сгенерировано {len(chunk_embeddings)} эмбеддингов, размерность: {emb_dim}")
-            else:
-                logger.warning("⚠️ Не удалось сгенерировать эмбеддинги")
+            if chunk_embeddings is None:
+                chunk_embeddings = await self.embed_document_chunks(metrics)
+            chunk_embeddings_fp16 = chunk_embeddings.astype(np.float16)
             
             # Создаем чанки с эмбеддингами используя прямой SQL для обхода проблем с мапперами
-            from sqlalchemy import text as sql_text
-            saved_count = 0
-            for i, (chunk_data, chunk_embedding) in enumerate(zip(chunks, chunk_embeddings)):
-                try:
-                    # Проверяем размерность эмбеддинга
-                    emb_list = chunk_embedding.tolist() if hasattr(chunk_embedding, 'tolist') else list(chunk_embedding)
-                    emb_str = '[' + ','.join(map(str, emb_list)) + ']'
-                    
-                    chunk_id_new = str(uuid.uuid4())
-                    chunk_metadata_json = json.dumps({
-                            "filename": metrics.get("filename"),
-                            "classification": classification_result
-                        })
-                    
-                    # Используем прямой SQL запрос с правильным синтаксисом для pgvector
-                    await db.execute(
-                        sql_text("""
-                            INSERT INTO document_chunks 
-                            (id, document_id, chunk_id, text, start_pos, end_pos, embedding, chunk_metadata)
-                            VALUES 
-                            (:id, :document_id, :chunk_id, :text, :start_pos, :end_pos, CAST(:embedding AS vector), :chunk_metadata)
-                        """),
-                        {
-                            "id": chunk_id_new,
-                            "document_id": document_id,
-                            "chunk_id": i,
-                            "text": chunk_data["text"],
-                            "start_pos": chunk_data["start_pos"],
-                            "end_pos": chunk_data["end_pos"],
-                            "embedding": emb_str,
-                            "chunk_metadata": chunk_metadata_json
-                        }
-                    )
-                    saved_count += 1
-                except Exception as chunk_error:
-                    logger.error(f"❌ Ошибка при создании чанка {i}: {chunk_error}")
-                    import traceback
-                    traceback.print_exc()
+            # Все строки уходят одним COPY/executemany вместо INSERT на каждый чанк (_insert_chunk_rows)
+            # Метаданные одинаковы для всех чанков документа - сериализуем один раз
+            chunk_metadata_json = orjson.dumps({
+                "filename": metrics.get("filename"),
+                "classification": classification_result
+            }).decode()
+            rows = []
+            for i, (chunk_data, chunk_embedding) in enumerate(zip(chunks, chunk_embeddings_fp16)):
+                rows.append({
+                    "id": uuid.uuid4(),
+                    "document_id": uuid.UUID(str(document_id)),
+                    "chunk_id": i,
+                    "text": chunk_data["text"],
+                    "start_pos": chunk_data["start_pos"],
+                    "end_pos": chunk_data["end_pos"],
+                    # halfvec: FP16 ndarray уходит в Postgres бинарным кодеком pgvector
+                    "embedding": chunk_embedding,
+                    "chunk_metadata": chunk_metadata_json
+                })
             
-            await db.commit()
+            await self._insert_chunk_rows(db, rows)
+            saved_count = len(rows)
+            
+            if commit:
+                await db.commit()
+            self._search_cache.clear()  # Результаты поиска изменились
             logger.info(f"✅ RAG сохранил {saved_count}/{len(chunks)} чанков в Postgres для документа {document_id}")
             
         except Exception as e:
-            await db.rollback()
+            if commit:
+                await db.rollback()
             logger.error(f"❌ Ошибка при сохранении метрик в Postgres: {e}")
             raise
     
@@ -399,51 +1085,48 @@ class RAGService:
             top_k = settings.RAG_TOP_K
         
         try:
-            # Генерируем эмбеддинг запроса
-            query_embedding = self.generate_embedding(query)
+            # Генерируем эмбеддинг запроса (повторные запросы берутся из кэша)
+            query_embedding = await self._embed_query_cached(query)
+            
+            # Семантически близкий запрос уже выполнялся - не идем в Postgres
+            if settings.RAG_SEMANTIC_CACHE_SIZE > 0:
+                cached_chunks = self._search_cache.get(query_embedding, top_k)
+                if cached_chunks is not None:
+                    logger.info(f"✅ RAG вернул {len(cached_chunks)} чанков из семантического кэша")
+                    return cached_chunks
             
             # Поиск в Postgres через векторное сравнение
-            # Используем правильный синтаксис для pgvector с asyncpg
-            embedding_list = query_embedding.tolist()
-            embedding_str = '[' + ','.join(map(str, embedding_list)) + ']'
-            
-            query_sql = f"""
-                SELECT 
-                    dc.id,
-                    dc.document_id,
-                    dc.chunk_id,
-                    dc.text,
-                    dc.start_pos,
-                    dc.end_pos,
-                    dc.chunk_metadata,
-                    d.title as document_title,
-                    d.type as document_type,
-                    d.path as document_path,
-                    1 - (dc.embedding <=> '{embedding_str}'::vector) as similarity
-                FROM document_chunks dc
-                JOIN documents d ON dc.document_id = d.id
-                WHERE d.is_deleted = false
-                ORDER BY similarity DESC
-                LIMIT {top_k}
-            """
-            
-            result = await db.execute(text(query_sql))
-            
-            chunks = []
-            for row in result:
-                chunks.append({
-                    "chunk_id": str(row.id),
-                    "document_id": str(row.document_id),
-                    "chunk_index": row.chunk_id,
-                    "text": row.text,
-                    "start_pos": row.start_pos,
-                    "end_pos": row.end_pos,
-                    "metadata": json.loads(row.chunk_metadata) if row.chunk_metadata else {},
-                    "document_title": row.document_title,
-                    "document_type": row.document_type,
-                    "document_path": row.document_path,
-                    "similarity": float(row.similarity)
-                })
+            # Эмбеддинг передается параметром: кодек pgvector кодирует ndarray в halfvec бинарно
+            query_params = {
+                "embedding": query_embedding.astype(np.float16),
+                "candidates": top_k * _candidates_factor()
+            }
+            
+            await self._set_ef_search(db, query_params["candidates"])
+            result = await db.execute(_search_sql(SEARCH_FOR_QWEN_SQL, query_embedding), query_params)
+            ranked = _rerank_by_cosine(result.all(), query_embedding, top_k)
+            
+            # Позиционная распаковка кортежей (порядок столбцов - SEARCH_FOR_QWEN_SQL) дешевле доступа по атрибутам
+            chunks = [
+                {
+                    "chunk_id": str(chunk_uuid),
+                    "document_id": str(document_uuid),
+                    "chunk_index": chunk_index,
+                    "text": chunk_text,
+                    "start_pos": start_pos,
+                    "end_pos": end_pos,
+                    "metadata": orjson.loads(chunk_metadata) if chunk_metadata else {},
+                    "document_title": document_title,
+                    "document_type": document_type,
+                    "document_path": document_path,
+                    "similarity": similarity
+                }
+                for (chunk_uuid, document_uuid, chunk_index, chunk_text, start_pos, end_pos, chunk_metadata,
+                     document_title, document_type, document_path), similarity in ranked
+            ]
+            
+            if settings.RAG_SEMANTIC_CACHE_SIZE > 0:
+                self._search_cache.put(query_embedding, top_k, chunks)
             
             logger.info(f"✅ RAG нашел {len(chunks)} релевантных чанков для Qwen")
             return chunks
@@ -452,6 +1135,34 @@ class RAGService:
             logger.error(f"❌ Ошибка при поиске для Qwen: {e}")
             raise
     
+    async def _insert_chunk_rows(self, db: AsyncSession, rows: List[Dict]):
+        """
+        Вставка чанков в транзакции сессии: от _COPY_MIN_ROWS строк - бинарный COPY
+        (copy_records_to_table asyncpg, halfvec кодируется кодеком pgvector), иначе один
+        executemany подготовленного INSERT_CHUNK_SQL
+        """
+        if not rows:
+            return
+        if len(rows) < _COPY_MIN_ROWS:
+            await db.execute(INSERT_CHUNK_SQL, rows)
+            return
+        
+        connection = await db.connection()
+        raw_connection = await connection.get_raw_connection()
+        records = [tuple(row[column] for column in _CHUNK_COLUMNS) for row in rows]
+        await raw_connection.driver_connection.copy_records_to_table(
+            "document_chunks", records=records, columns=_CHUNK_COLUMNS
+        )
+    
+    async def _set_ef_search(self, db: AsyncSession, candidates: int):
+        """
+        hnsw.ef_search для запроса: баланс recall/latency (RAG_HNSW_EF_SEARCH), но не меньше
+        числа кандидатов - HNSW не возвращает больше ef_search строк. Не больше _MAX_EF_SEARCH:
+        при большем числе кандидатов индекс вернет до _MAX_EF_SEARCH строк вместо ошибки запроса
+        """
+        ef_search = min(max(settings.RAG_HNSW_EF_SEARCH, candidates), _MAX_EF_SEARCH)
+        await db.execute(SET_EF_SEARCH_SQL, {"ef_search": str(ef_search)})
+    
     async def add_document_chunks(
         self,
         db: AsyncSession,
@@ -459,27 +1170,31 @@ class RAGService:
         chunks: List[Dict]
     ):
         """Add document chunks with embeddings to vector store (legacy method)"""
-        from app.models.vector_store import DocumentChunk
-        import uuid
         
         try:
-            for chunk_data in chunks:
-                embedding = self.generate_embedding(chunk_data['text'])
-                
-                chunk = DocumentChunk(
-                    id=uuid.uuid4(),
-                    document_id=uuid.UUID(document_id),
-                    chunk_id=chunk_data['chunk_id'],
-                    text=chunk_data['text'],
-                    start_pos=chunk_data['start_pos'],
-                    end_pos=chunk_data['end_pos'],
-                    embedding=embedding.tolist(),
-                    chunk_metadata=json.dumps(chunk_data.get('metadata', {})) if chunk_data.get('metadata') else None
-                )
-                
-                db.add(chunk)
+            # Один батчевый проход модели вместо отдельного вызова на каждый чанк
+            embeddings = np.asarray(
+                await self._embed_texts_async([chunk_data['text'] for chunk_data in chunks]), dtype=np.float16
+            )
+            
+            # Одной пачкой, как в save_metrics_to_postgres, вместо ORM-объекта на каждый чанк
+            rows = [
+                {
+                    "id": uuid.uuid4(),
+                    "document_id": uuid.UUID(document_id),
+                    "chunk_id": chunk_data.get('chunk_id', i),
+                    "text": chunk_data['text'],
+                    "start_pos": chunk_data['start_pos'],
+                    "end_pos": chunk_data['end_pos'],
+                    "embedding": embedding,
+                    "chunk_metadata": orjson.dumps(chunk_data['metadata']).decode() if chunk_data.get('metadata') else None
+                }
+                for i, (chunk_data, embedding) in enumerate(zip(chunks, embeddings))
+            ]
+            await self._insert_chunk_rows(db, rows)
             
             await db.commit()
+            self._search_cache.clear()
             logger.info(f"✅ Добавлено {len(chunks)} чанков для документа {document_id}")
             
         except Exception as e:
@@ -499,51 +1214,39 @@ class RAGService:
             top_k = settings.RAG_TOP_K
         
         try:
-            query_embedding = self.generate_embedding(query)
-            
-            # Используем правильный синтаксис для pgvector с asyncpg
-            embedding_list = query_embedding.tolist()
-            embedding_str = '[' + ','.join(map(str, embedding_list)) + ']'
-            
-            query_sql = f"""
-                SELECT 
-                    dc.id,
-                    dc.document_id,
-                    dc.chunk_id,
-                    dc.text,
-                    dc.start_pos,
-                    dc.end_pos,
-                    dc.chunk_metadata,
-                    d.title as document_title,
-                    d.type as document_type,
-                    1 - (dc.embedding <=> '{embedding_str}'::vector) as similarity
-                FROM document_chunks dc
-                JOIN documents d ON dc.document_id = d.id
-                WHERE d.is_deleted = false
-            """
+            query_embedding = await self._embed_query_cached(query)
             
+            # Эмбеддинг передается параметром: кодек pgvector кодирует ndarray в halfvec бинарно
+            query_params = {
+                "embedding": query_embedding.astype(np.float16),
+                "candidates": top_k * _candidates_factor()
+            }
             if document_ids:
-                doc_ids_str = ','.join([f"'{str(doc_id)}'" for doc_id in document_ids])
-                query_sql += f" AND dc.document_id = ANY(ARRAY[{doc_ids_str}]::uuid[])"
-            
-            query_sql += f" ORDER BY similarity DESC LIMIT {top_k}"
-            
-            result = await db.execute(text(query_sql))
-            
-            chunks = []
-            for row in result:
-                chunks.append({
-                    "chunk_id": str(row.id),
-                    "document_id": str(row.document_id),
-                    "chunk_index": row.chunk_id,
-                    "text": row.text,
-                    "start_pos": row.start_pos,
-                    "end_pos": row.end_pos,
-                    "metadata": json.loads(row.chunk_metadata) if row.chunk_metadata else {},
-                    "document_title": row.document_title,
-                    "document_type": row.document_type,
-                    "similarity": float(row.similarity)
-                })
+                query_params["document_ids"] = [uuid.UUID(str(doc_id)) for doc_id in document_ids]
+                search_sql = SEARCH_SIMILAR_IN_DOCUMENTS_SQL
+            else:
+                search_sql = SEARCH_SIMILAR_SQL
+            
+            await self._set_ef_search(db, query_params["candidates"])
+            result = await db.execute(_search_sql(search_sql, query_embedding), query_params)
+            ranked = _rerank_by_cosine(result.all(), query_embedding, top_k)
+            
+            chunks = [
+                {
+                    "chunk_id": str(chunk_uuid),
+                    "document_id": str(document_uuid),
+                    "chunk_index": chunk_index,
+                    "text": chunk_text,
+                    "start_pos": start_pos,
+                    "end_pos": end_pos,
+                    "metadata": orjson.loads(chunk_metadata) if chunk_metadata else {},
+                    "document_title": document_title,
+                    "document_type": document_type,
+                    "similarity": similarity
+                }
+                for (chunk_uuid, document_uuid, chunk_index, chunk_text, start_pos, end_pos, chunk_metadata,
+                     document_title, document_type), similarity in ranked
+            ]
             
             logger.info(f"Найдено {len(chunks)} релевантных чанков для запроса: {query[:50]}")
             return chunks
@@ -555,18 +1258,27 @@ class RAGService:
     async def delete_document_chunks(
         self,
         db: AsyncSession,
-        document_id: str
+        document_id: str,
+        commit: bool = True
     ):
-        """Delete all chunks for a document"""
+        """
+        Delete all chunks for a document
+        
+        Args:
+            commit: False - удаление в транзакции вызывающего кода (commit и rollback - на его стороне)
+        """
         try:
             await db.execute(
                 text("DELETE FROM document_chunks WHERE document_id = :document_id"),
                 {"document_id": document_id}
             )
-            await db.commit()
+            if commit:
+                await db.commit()
+            self._search_cache.clear()
             logger.info(f"✅ Удалены чанки для документа {document_id}")
         except Exception as e:
-            await db.rollback()
+            if commit:
+                await db.rollback()
             logger.error(f"❌ Ошибка при удалении чанков: {e}")
             raise
 
@@ -3,35 +3,78 @@ RAG processing tasks for Celery
 """
 import asyncio
 import logging
-from typing import Dict, Any
+import threading
+from typing import Dict, Any, Optional
 from celery import Task
+from celery.signals import worker_process_init
 
 from app.core.celery_app import celery_app
+from app.core.config import settings
 from app.services.document_processor import DocumentProcessor
-from app.services.rag_service import RAGService
+from app.services.rag_service import rag_service
 from app.services.qwen_service import QwenService
 from app.core.database import AsyncSessionLocal
 from app.models.document import Document
 from sqlalchemy import select
 import uuid
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# uvloop (ставится с uvicorn[standard]) для event loop воркера, если доступен
+try:
+    import uvloop
+    _new_event_loop = uvloop.new_event_loop
+except ImportError:
+    _new_event_loop = asyncio.new_event_loop
+
+# Один процессор текста на процесс воркера (без состояния, общий для задач)
+doc_processor = DocumentProcessor()
+
+
+# Один event loop на процесс воркера в фоновом потоке: соединения пула Postgres (asyncpg
+# привязан к loop), Redis и очереди батчинга эмбеддингов переживают задачи
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_worker_loop_lock = threading.Lock()
+
+
+def _get_worker_loop() -> asyncio.AbstractEventLoop:
+    """Постоянный event loop воркера (создается при первой задаче)"""
+    global _worker_loop
+    if _worker_loop is None:
+        with _worker_loop_lock:
+            if _worker_loop is None:
+                loop = _new_event_loop()
+                threading.Thread(target=loop.run_forever, name="celery-async-loop", daemon=True).start()
+                _worker_loop = loop
+    return _worker_loop
+
+
+@worker_process_init.connect
+def _preload_models(**kwargs):
+    """
+    Загрузка модели эмбеддингов в процессе воркера при его старте, а не внутри первой задачи
+    (QWEN_WARMUP_ON_STARTUP). Задача не генерирует текст (классификация - по ключевым словам),
+    поэтому Qwen загружается, только если эмбеддинги строятся на нем (RAG_EMBEDDING_MODEL=qwen3-4b)
+    """
+    if not settings.QWEN_WARMUP_ON_STARTUP:
+        return
+    try:
+        logger.info("🔥 [Celery] Загрузка модели эмбеддингов в процессе воркера...")
+        if rag_service._use_sentence_transformer():
+            rag_service._embedding_service.load()
+        else:
+            rag_service._ensure_qwen_loaded()
+        logger.info("✅ [Celery] Модель эмбеддингов загружена")
+    except Exception as e:
+        logger.warning(f"⚠️ [Celery] Не удалось заранее загрузить модели: {e}")
+
 
 class AsyncTask(Task):
     """Base task class that runs async functions"""
     
     def __call__(self, *args, **kwargs):
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        return loop.run_until_complete(self.run_async(*args, **kwargs))
+        return asyncio.run_coroutine_threadsafe(self.run_async(*args, **kwargs), _get_worker_loop()).result()
     
     async def run_async(self, *args, **kwargs):
         raise NotImplementedError
@@ -74,9 +117,7 @@ class ProcessDocumentRAGTask(AsyncTask):
                 
                 logger.info(f"📄 [Celery] Processing document: {document.title}")
                 
-                # Initialize services
-                doc_processor = DocumentProcessor()
-                rag_service = RAGService()
+                # Initialize services (QwenService - синглтон)
                 qwen_service = QwenService()
                 
                 # Extract text (load_file is synchronous)
@@ -92,14 +133,18 @@ class ProcessDocumentRAGTask(AsyncTask):
                 file_data = download_file(document.path)
                 file_ext = Path(document.path).suffix
                 
-                with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-                    tmp_file.write(file_data)
-                    tmp_path = tmp_file.name
-                
-                try:
-                    text = doc_processor.load_file(tmp_path)
-                finally:
-                    os.unlink(tmp_path)
+                if file_ext.lower() in DocumentProcessor.PLAIN_TEXT_EXTENSIONS:
+                    # Текст декодируется из памяти, без временного файла
+                    text = doc_processor.load_text_bytes(file_data, file_ext)
+                else:
+                    with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
+                        tmp_file.write(file_data)
+                        tmp_path = tmp_file.name
+                    
+                    try:
+                        text = doc_processor.load_file(tmp_path)
+                    finally:
+                        os.unlink(tmp_path)
                 
                 if not text or len(text.strip()) < 10:
                     logger.warning(f"⚠️ [Celery] No text extracted from {document.title}")
@@ -108,38 +153,35 @@ class ProcessDocumentRAGTask(AsyncTask):
                         "error": "No text content extracted"
                     }
                 
-                # Classify document with Qwen (synchronous method)
-                logger.info(f"🤖 [Celery] Classifying document with Qwen")
+                # Classify document (быстрая классификация по ключевым словам, без генерации Qwen:
+                # сканирование начала текста - микросекунды, в поток не выносится)
+                logger.info(f"🏷️ [Celery] Classifying document by keywords")
                 classification = qwen_service.classify_document(
                     text=text[:1000],  # First 1000 chars for classification
                     filename=document.title
                 )
                 
-                # Update document classification
-                if classification.get("tags"):
-                    document.tags = classification.get("tags", [])
-                if classification.get("description"):
-                    document.summary = classification.get("description", "")
-                await session.commit()
-                
-                logger.info(f"✅ [Celery] Document classified: {classification.get('type', 'unknown')}")
-                
                 # Process through RAG - generate chunks and embeddings
                 logger.info(f"🔍 [Celery] Processing with RAG")
                 
                 # Split text into chunks
                 chunk_size = 500
                 chunk_overlap = 100
-                chunks = []
-                
-                for i in range(0, len(text), chunk_size - chunk_overlap):
-                    chunk_text = text[i:i + chunk_size]
-                    if len(chunk_text.strip()) > 50:  # Skip very short chunks
-                        chunks.append({
-                            "text": chunk_text,
-                            "start_pos": i,
-                            "end_pos": min(i + chunk_size, len(text))
-                        })
+                text_length = len(text)
+                
+                # Границы всех чанков считаются векторно, в цикле остаются только срезы
+                starts = np.arange(0, text_length, chunk_size - chunk_overlap, dtype=np.int64)
+                ends = np.minimum(starts + chunk_size, text_length)
+                chunks = [
+                    {
+                        "text": chunk_text,
+                        "start_pos": start,
+                        "end_pos": end
+                    }
+                    for start, end in zip(starts.tolist(), ends.tolist())
+                    # Skip very short chunks (длина среза <= 50 - заведомо короткий, без strip)
+                    if end - start > 50 and len((chunk_text := text[start:end]).strip()) > 50
+                ]
                 
                 logger.info(f"📊 [Celery] Created {len(chunks)} chunks")
                 
@@ -156,6 +198,15 @@ class ProcessDocumentRAGTask(AsyncTask):
                 
                 logger.info(f"✅ [Celery] RAG processing completed: {chunks_created} chunks created")
                 
+                # Update document classification
+                if classification.get("tags"):
+                    document.tags = classification.get("tags", [])
+                if classification.get("description"):
+                    document.summary = classification.get("description", "")
+                await session.commit()
+                
+                logger.info(f"✅ [Celery] Document classified: {classification.get('type', 'unknown')}")
+                
                 return {
                     "success": True,
                     "document_id": str(document.id),
@@ -7,6 +7,7 @@
 """
 import asyncio
 import sys
+from itertools import islice
 from pathlib import Path
 
 # Добавляем путь к приложению
@@ -17,6 +18,7 @@ from app.core.config import settings
 from app.core.database import engine, AsyncSessionLocal
 from app.core import redis_client as redis_module
 from app.core import storage
+from minio.deleteobjects import DeleteObject
 import logging
 
 logging.basicConfig(
@@ -25,13 +27,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Максимум ключей в одном запросе удаления S3/MinIO
+MINIO_DELETE_BATCH_SIZE = 1000
+
+
+def quote_identifier(name: str) -> str:
+    """Экранирование идентификатора PostgreSQL (как quote_ident)"""
+    return '"' + name.replace('"', '""') + '"'
+
 
 async def cleanup_postgres():
     """Очистить PostgreSQL базу данных"""
     try:
         logger.info("🗑️  Очистка PostgreSQL...")
         
-        async with AsyncSessionLocal() as session:
+        async with AsyncSessionLocal() as session, session.begin():
             # Получаем список всех таблиц
             result = await session.execute(text("""
                 SELECT tablename FROM pg_tables 
@@ -46,19 +56,15 @@ async def cleanup_postgres():
             # Отключаем внешние ключи временно
             await session.execute(text("SET session_replication_role = 'replica'"))
             
-            # Удаляем данные из всех таблиц
-            for table in tables:
-                try:
-                    await session.execute(text(f"TRUNCATE TABLE {table} CASCADE"))
-                    logger.info(f"   ✅ Очищена таблица: {table}")
-                except Exception as e:
-                    logger.warning(f"   ⚠️  Не удалось очистить таблицу {table}: {e}")
+            # Все таблицы одним TRUNCATE в одной транзакции (имена экранируются как идентификаторы)
+            table_list = ", ".join(quote_identifier(table) for table in tables)
+            await session.execute(text(f"TRUNCATE TABLE {table_list} RESTART IDENTITY CASCADE"))
+            logger.info(f"   ✅ Очищены таблицы: {', '.join(tables)}")
             
             # Включаем обратно внешние ключи
             await session.execute(text("SET session_replication_role = 'origin'"))
-            await session.commit()
-            
-            logger.info("✅ PostgreSQL очищена")
+        
+        logger.info("✅ PostgreSQL очищена")
             
     except Exception as e:
         logger.error(f"❌ Ошибка при очистке PostgreSQL: {e}")
@@ -104,23 +110,28 @@ async def cleanup_minio():
             logger.warning(f"   ⚠️  Bucket {bucket_name} не существует")
             return
         
-        # Получаем список всех объектов
+        # Список объектов читается лениво, пачками по MINIO_DELETE_BATCH_SIZE;
+        # каждая пачка удаляется одним запросом Multi-Object Delete вместо запроса на объект
         objects = client.list_objects(bucket_name, recursive=True)
-        objects_list = list(objects)
-        
-        if not objects_list:
+        listed_count = 0
+        deleted_count = 0
+        while True:
+            batch = [DeleteObject(obj.object_name) for obj in islice(objects, MINIO_DELETE_BATCH_SIZE)]
+            if not batch:
+                break
+            
+            # remove_objects ленивый: ошибки (и сами удаления) происходят при итерации
+            failed = 0
+            for error in client.remove_objects(bucket_name, batch):
+                failed += 1
+                logger.warning(f"   ⚠️  Не удалось удалить {error.name}: {error.message}")
+            listed_count += len(batch)
+            deleted_count += len(batch) - failed
+        
+        if listed_count == 0:
             logger.info("   ✅ Bucket пуст")
             return
         
-        # Удаляем все объекты
-        deleted_count = 0
-        for obj in objects_list:
-            try:
-                client.remove_object(bucket_name, obj.object_name)
-                deleted_count += 1
-            except Exception as e:
-                logger.warning(f"   ⚠️  Не удалось удалить {obj.object_name}: {e}")
-        
         logger.info(f"✅ MinIO очищена: удалено {deleted_count} объектов")
         
     except Exception as e:
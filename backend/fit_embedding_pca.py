@@ -0,0 +1,72 @@
+"""
+Скрипт обучения PCA-проекции эмбеддингов Qwen3-4B (RAG_EMBEDDING_MODEL=qwen3-4b)
+Скрытые состояния 2560 измерений проецируются в RAG_EMBEDDING_DIM (например 512):
+меньше индекс, дешевле расчет расстояний в pgvector
+Порядок: fit_embedding_pca.py -> fix_vector_dimension.py -> reprocess_documents.py
+"""
+import asyncio
+import os
+import sys
+
+# Добавляем путь к приложению
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+from sqlalchemy import text
+from app.core.config import settings
+from app.core.database import engine
+
+# Число фрагментов-образцов для обучения проекции
+SAMPLE_SIZE = 4096
+
+
+async def load_sample_texts(limit: int):
+    """Случайная выборка текстов уже сохраненных чанков"""
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            text("SELECT text FROM document_chunks ORDER BY random() LIMIT :limit"),
+            {"limit": limit}
+        )
+        return [row[0] for row in result if row[0]]
+
+
+async def fit_embedding_pca():
+    """Обучить PCA-проекцию и сохранить в RAG_EMBEDDING_PCA_PATH"""
+    from app.services.rag_service import rag_service, QWEN_EMBEDDING_MODEL
+
+    dim = settings.RAG_EMBEDDING_DIM
+    if settings.RAG_EMBEDDING_MODEL != QWEN_EMBEDDING_MODEL or not dim:
+        print("⚠️ PCA нужна только для RAG_EMBEDDING_MODEL=qwen3-4b с RAG_EMBEDDING_DIM > 0")
+        return
+
+    texts = await load_sample_texts(SAMPLE_SIZE)
+    print(f"📊 Образцов: {len(texts)}")
+    if len(texts) < dim:
+        print(f"❌ Нужно не меньше {dim} чанков (RAG_EMBEDDING_DIM)")
+        return
+
+    # Полные L2-нормализованные эмбеддинги без проекции: _pool_embeddings проецирует
+    # именно нормализованные векторы, поэтому mean и компоненты считаются по ним же
+    settings.RAG_EMBEDDING_DIM = 0
+    embeddings = np.asarray(
+        await asyncio.to_thread(rag_service.generate_embeddings_batch, texts),
+        dtype=np.float32
+    )
+
+    print(f"🔄 PCA {embeddings.shape[1]} -> {dim}...")
+    mean = embeddings.mean(axis=0)
+    _, singular_values, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+    components = vt[:dim].T  # [hidden_size, dim]
+    explained = (singular_values[:dim] ** 2).sum() / (singular_values ** 2).sum()
+
+    os.makedirs(os.path.dirname(settings.RAG_EMBEDDING_PCA_PATH), exist_ok=True)
+    np.savez(settings.RAG_EMBEDDING_PCA_PATH, mean=mean, components=components)
+    print(f"✅ Проекция сохранена: {settings.RAG_EMBEDDING_PCA_PATH} (объясненная дисперсия {explained:.1%})")
+    print("✅ Готово! Теперь запустите fix_vector_dimension.py и переобработайте документы.")
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("Обучение PCA-проекции эмбеддингов")
+    print("=" * 60)
+    asyncio.run(fit_embedding_pca())
@@ -1,6 +1,9 @@
 """
 Скрипт для исправления размерности вектора в таблице document_chunks
-Qwen3-4B имеет hidden_size=2560, а в таблице было Vector(384)
+Размерность берется из модели эмбеддингов (settings.RAG_EMBEDDING_MODEL):
+multilingual-e5-small - 384, скрытые состояния Qwen3-4B - 2560;
+RAG_EMBEDDING_DIM > 0 - усеченная (Matryoshka) или PCA-проекция размерность
+Эмбеддинги хранятся как halfvec (FP16): вдвое меньше данных на строку и в индексе
 """
 import asyncio
 import os
@@ -10,10 +13,28 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from sqlalchemy import text
-from app.core.database import engine
+from app.core.config import settings
+from app.core.database import engine, EMBEDDING_INDEX_SQL, EMBEDDING_BINARY_INDEX_SQL
+
+# hidden_size Qwen3-4B
+QWEN_EMBEDDING_DIM = 2560
+# Минимальная версия pgvector с типом halfvec
+PGVECTOR_HALFVEC_VERSION = (0, 7)
+
+
+def get_embedding_dimension() -> int:
+    """Размерность эмбеддингов настроенной модели"""
+    from app.services.rag_service import QWEN_EMBEDDING_MODEL
+    if settings.RAG_EMBEDDING_MODEL == QWEN_EMBEDDING_MODEL:
+        return settings.RAG_EMBEDDING_DIM or QWEN_EMBEDDING_DIM
+    from app.services.embedding_service import EmbeddingService
+    return EmbeddingService().dimension()
+
 
 async def fix_vector_dimension():
-    """Исправить размерность вектора с 384 на 2560"""
+    """Привести размерность вектора к модели эмбеддингов"""
+    dim = get_embedding_dimension()
+    print(f"📏 Размерность эмбеддингов {settings.RAG_EMBEDDING_MODEL}: {dim}")
     
     async with engine.begin() as conn:
         print("🔄 Проверяю таблицу document_chunks...")
@@ -31,6 +52,13 @@ async def fix_vector_dimension():
             print("⚠️ Таблица document_chunks не существует. Она будет создана автоматически при запуске приложения.")
             return
         
+        # halfvec и HNSW по halfvec появились в pgvector 0.7.0
+        result = await conn.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'"))
+        version = result.scalar()
+        if version is None or tuple(int(part) for part in version.split(".")[:2]) < PGVECTOR_HALFVEC_VERSION:
+            print(f"❌ Нужен pgvector >= 0.7.0 (установлен: {version or 'нет'}). Обновите расширение: ALTER EXTENSION vector UPDATE")
+            return
+        
         # Проверяем текущую размерность
         result = await conn.execute(text("""
             SELECT COUNT(*) FROM document_chunks
@@ -43,13 +71,16 @@ async def fix_vector_dimension():
         await conn.execute(text("DELETE FROM document_chunks"))
         
         # Изменяем размерность столбца embedding
-        print("🔧 Изменяю размерность вектора с 384 на 2560...")
+        print(f"🔧 Изменяю тип вектора на halfvec({dim})...")
         try:
-            await conn.execute(text("""
+            await conn.execute(text("DROP INDEX IF EXISTS ix_document_chunks_embedding"))
+            # Выражение бинарного индекса содержит старую размерность bit(N)
+            await conn.execute(text("DROP INDEX IF EXISTS ix_document_chunks_embedding_bin"))
+            await conn.execute(text(f"""
                 ALTER TABLE document_chunks 
-                ALTER COLUMN embedding TYPE vector(2560)
+                ALTER COLUMN embedding TYPE halfvec({dim})
             """))
-            print("✅ Размерность вектора изменена на 2560")
+            print(f"✅ Тип вектора изменен на halfvec({dim})")
         except Exception as e:
             if "does not exist" in str(e) or "column" in str(e).lower():
                 print(f"⚠️ Столбец не найден или уже имеет правильный тип: {e}")
@@ -64,17 +95,21 @@ async def fix_vector_dimension():
             pass
         
         try:
-            await conn.execute(text("""
-                CREATE INDEX ix_document_chunks_embedding 
-                ON document_chunks 
-                USING ivfflat (embedding vector_cosine_ops)
-                WITH (lists = 100)
-            """))
-            print("✅ Индекс создан")
+            # HNSW не требует обучающих данных (в отличие от ivfflat) - можно создавать на пустой таблице
+            async with conn.begin_nested():
+                await conn.execute(text(EMBEDDING_INDEX_SQL))
+            print("✅ HNSW индекс создан")
         except Exception as e:
-            # ivfflat требует минимум 100 записей для lists=100
             print(f"⚠️ Индекс будет создан позже: {e}")
         
+        if settings.RAG_BINARY_PREFILTER:
+            try:
+                async with conn.begin_nested():
+                    await conn.execute(text(EMBEDDING_BINARY_INDEX_SQL))
+                print(f"✅ HNSW индекс по бинарным эмбеддингам bit({dim}) создан")
+            except Exception as e:
+                print(f"⚠️ Бинарный индекс будет создан позже: {e}")
+        
         print("✅ Готово! Теперь нужно перезагрузить документы.")
 
 if __name__ == "__main__":
@@ -3,8 +3,8 @@ Script to initialize database with test user
 """
 import asyncio
 import sys
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from app.core.config import settings
 from app.core.security import get_password_hash
 from app.models.user import User
@@ -13,17 +13,15 @@ import uuid
 async def init_test_user():
     """Create test user if not exists"""
     engine = create_async_engine(settings.DATABASE_URL, echo=False)
-    async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async_session = async_sessionmaker(engine, expire_on_commit=False)
     
     async with async_session() as session:
-        # Check if demo user exists
-        from sqlalchemy import select
-        result = await session.execute(
-            select(User).where(User.email == "demo@sirius-dms.com")
+        # Check if demo user exists (только id, без загрузки всей строки User)
+        existing_user_id = await session.scalar(
+            select(User.id).where(User.email == "demo@sirius-dms.com").limit(1)
         )
-        existing_user = result.scalar_one_or_none()
         
-        if not existing_user:
+        if existing_user_id is None:
             # Create demo user
             demo_user = User(
                 id=uuid.uuid4(),
@@ -3,112 +3,513 @@
 Скрипт для повторной обработки документов через RAG
 """
 import asyncio
+import hashlib
 import sys
 import os
+import orjson
+import shutil
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 # Добавляем путь к приложению
 sys.path.insert(0, str(Path(__file__).parent))
 
-from app.core.database import AsyncSessionLocal
+from app.core.database import AsyncSessionLocal, engine
 from app.services.rag_service import rag_service
 from app.services.qwen_service import qwen_service
-from app.core.storage import download_file
+from app.core.config import settings
+from app.core.storage import download_file, download_file_to, get_file_stat
 from app.services.document_processor import DocumentProcessor
-from sqlalchemy import select
+from sqlalchemy import Row, select, text
 from app.models.document import Document
 import tempfile
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def reprocess_documents():
-    """Обработать все документы через RAG"""
-    async with AsyncSessionLocal() as db:
-        # Получаем все документы
-        result = await db.execute(
-            select(Document).where(Document.is_deleted == False)
-        )
-        docs = result.scalars().all()
-        
-        logger.info(f"📄 Найдено документов для обработки: {len(docs)}")
+# Число документов, обрабатываемых одновременно
+REPROCESS_CONCURRENCY = int(os.getenv("REPROCESS_CONCURRENCY", "8"))
+# Параллельные HEAD-запросы к MinIO перед обработкой (не больше MINIO_MAX_POOL_CONNECTIONS)
+STAT_WORKERS = min(32, settings.MINIO_MAX_POOL_CONNECTIONS)
+# Файлы до REPROCESS_SHM_MAX_BYTES скачиваются в tmpfs (/dev/shm): запись и повторное чтение
+# парсером идут в памяти, без диска. Крупные - на диск: /dev/shm ограничен (в Docker 64 МБ),
+# а одновременно на нем лежит до REPROCESS_CONCURRENCY файлов
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+REPROCESS_SHM_MAX_BYTES = int(os.getenv("REPROCESS_SHM_MAX_BYTES", str(4 << 20)))
+# Начало текста, которое читает классификация (промпт Qwen - до 6400 символов, fallback - 8192)
+CLASSIFY_TEXT_CHARS = 8192
+
+# Кэш классификации по SHA-256 извлеченного текста: ревизии, повторные загрузки и типовые
+# формы с идентичным текстом не классифицируются Qwen повторно. Метрики не кэшируются -
+# process_document_for_metrics только нарезает текст, без вызова модели
+CREATE_TEXT_CACHE_SQL = text("""
+    CREATE TABLE IF NOT EXISTS document_text_cache (
+        sha256 text PRIMARY KEY,
+        classification jsonb NOT NULL
+    )
+""")
+SYNC_COMMIT_OFF_SQL = text("SET LOCAL synchronous_commit = off")
+# Кэшируются только результаты модели ("processed": true); fallback-классификация по ключевым
+# словам (таймаут, модель не загружена) не кэшируется и при следующей обработке повторяется
+SELECT_TEXT_CACHE_SQL = text("""
+    SELECT classification::text FROM document_text_cache
+    WHERE sha256 = :sha256 AND classification @> '{"processed": true}'
+""")
+INSERT_TEXT_CACHE_SQL = text("""
+    INSERT INTO document_text_cache (sha256, classification)
+    VALUES (:sha256, CAST(:classification AS jsonb))
+    ON CONFLICT (sha256) DO NOTHING
+""")
+
+# Почти-дубликаты (ревизии, типовые договоры): MinHash по 9-символьным шинглам текста и LSH-индекс
+# запуска. Документ, чей текст похож на уже классифицированный (оценка Жаккара >= порога),
+# получает его классификацию без Qwen. Чанки и эмбеддинги строятся из собственного текста документа.
+# Шинглы берутся из начала текста (NEAR_DUP_TEXT_CHARS), чтобы их множество не росло с размером файла
+NEAR_DUP_THRESHOLD = float(os.getenv("REPROCESS_NEAR_DUP_THRESHOLD", "0.9"))  # 0 - отключить
+NEAR_DUP_NUM_PERM = 128
+NEAR_DUP_SHINGLE_CHARS = 9
+NEAR_DUP_TEXT_CHARS = 1 << 18
+
+# Состояние обработки документа: при повторном запуске документ с тем же ETag объекта в MinIO,
+# обработанный теми же версиями RAG и Qwen, пропускается без загрузки (REPROCESS_FORCE=1 - обработать все)
+REPROCESS_FORCE = os.getenv("REPROCESS_FORCE", "0") == "1"
+CREATE_PROCESSING_STATE_SQL = text("""
+    CREATE TABLE IF NOT EXISTS processing_state (
+        document_id uuid PRIMARY KEY,
+        source_etag text NOT NULL,
+        rag_version text NOT NULL,
+        qwen_version text NOT NULL,
+        processed_at timestamptz NOT NULL DEFAULT now()
+    )
+""")
+SELECT_PROCESSING_STATES_SQL = text(
+    "SELECT document_id, source_etag, rag_version, qwen_version FROM processing_state"
+)
+UPSERT_PROCESSING_STATE_SQL = text("""
+    INSERT INTO processing_state (document_id, source_etag, rag_version, qwen_version, processed_at)
+    VALUES (:document_id, :source_etag, :rag_version, :qwen_version, now())
+    ON CONFLICT (document_id) DO UPDATE SET
+        source_etag = EXCLUDED.source_etag,
+        rag_version = EXCLUDED.rag_version,
+        qwen_version = EXCLUDED.qwen_version,
+        processed_at = EXCLUDED.processed_at
+""")
+
+# Журнал ошибок: документ, завершившийся ошибкой, при следующих запусках пропускается,
+# пока его файл в MinIO не изменится (REPROCESS_RETRY_FAILED=1 - повторить такие документы)
+REPROCESS_RETRY_FAILED = os.getenv("REPROCESS_RETRY_FAILED", "0") == "1"
+CREATE_FAILURES_SQL = text("""
+    CREATE TABLE IF NOT EXISTS reprocess_failures (
+        document_id uuid PRIMARY KEY,
+        source_etag text NOT NULL,
+        error text NOT NULL,
+        failed_at timestamptz NOT NULL DEFAULT now()
+    )
+""")
+SELECT_FAILURES_SQL = text("SELECT document_id, source_etag FROM reprocess_failures")
+UPSERT_FAILURE_SQL = text("""
+    INSERT INTO reprocess_failures (document_id, source_etag, error, failed_at)
+    VALUES (:document_id, :source_etag, :error, now())
+    ON CONFLICT (document_id) DO UPDATE SET
+        source_etag = EXCLUDED.source_etag,
+        error = EXCLUDED.error,
+        failed_at = EXCLUDED.failed_at
+""")
+DELETE_FAILURE_SQL = text("DELETE FROM reprocess_failures WHERE document_id = :document_id")
+DELETE_PROCESSING_STATE_SQL = text("DELETE FROM processing_state WHERE document_id = :document_id")
+
+
+def _pipeline_versions() -> Tuple[str, str]:
+    """
+    Версии RAG (пространство эмбеддингов - модель, размерность, префиксы, PCA-проекция; нарезка)
+    и Qwen, от которых зависит результат
+    """
+    rag_version = (
+        f"{settings.RAG_EMBEDDING_MODEL}:{rag_service.embedding_space_id()}:"
+        f"{settings.RAG_CHUNK_SIZE}:{settings.RAG_CHUNK_OVERLAP}"
+    )
+    return rag_version, settings.QWEN_MODEL_NAME
+
+
+async def _get_cached_classification(db, text_hash: str) -> Optional[Dict]:
+    """Классификация документа с тем же текстом или None"""
+    result = await db.execute(SELECT_TEXT_CACHE_SQL, {"sha256": text_hash})
+    value = result.scalar_one_or_none()
+    return orjson.loads(value) if value is not None else None
+
+
+async def _save_cached_classification(db, text_hash: str, classification: Dict):
+    """Сохраняется в транзакции документа (commit вместе с чанками)"""
+    await db.execute(INSERT_TEXT_CACHE_SQL, {
+        "sha256": text_hash,
+        "classification": orjson.dumps(classification, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    })
+
+
+class _NearDuplicateIndex:
+    """LSH-индекс MinHash текстов, классифицированных в этом запуске, и их классификации"""
+    
+    def __init__(self, lsh):
+        self._lsh = lsh
+        self._classifications: Dict[str, Dict] = {}
+    
+    @staticmethod
+    def minhash(text: str):
+        """MinHash нормализованного текста (регистр и пробелы не учитываются); CPU - вызывать в потоке"""
+        from datasketch import MinHash
         
-        processor = DocumentProcessor()
+        normalized = " ".join(text[:NEAR_DUP_TEXT_CHARS].lower().split())
+        shingles = {
+            normalized[i:i + NEAR_DUP_SHINGLE_CHARS].encode("utf-8")
+            for i in range(max(1, len(normalized) - NEAR_DUP_SHINGLE_CHARS + 1))
+        }
+        signature = MinHash(num_perm=NEAR_DUP_NUM_PERM)
+        signature.update_batch(shingles)
+        return signature
+    
+    def find(self, signature) -> Optional[Dict]:
+        """Классификация похожего текста или None"""
+        for key in self._lsh.query(signature):
+            return self._classifications[key]
+        return None
+    
+    def add(self, key: str, signature, classification: Dict):
+        if key not in self._classifications:
+            self._lsh.insert(key, signature)
+            self._classifications[key] = classification
+
+
+def _build_near_duplicate_index() -> Optional[_NearDuplicateIndex]:
+    if NEAR_DUP_THRESHOLD <= 0:
+        return None
+    try:
+        from datasketch import MinHashLSH
+    except ImportError:
+        logger.info("ℹ️ datasketch не установлен, поиск почти-дубликатов отключен")
+        return None
+    return _NearDuplicateIndex(MinHashLSH(threshold=NEAR_DUP_THRESHOLD, num_perm=NEAR_DUP_NUM_PERM))
+
+
+def _stat_or_none(object_name: str) -> Optional[Tuple[str, int]]:
+    """(ETag, размер) объекта или None, если объект недоступен (ошибка - только у этого документа)"""
+    try:
+        return get_file_stat(object_name)
+    except Exception as e:
+        logger.error(f"❌ Не удалось получить сведения об объекте {object_name}: {e}")
+        return None
+
+
+def _setup_logging() -> QueueListener:
+    """
+    Логи воркеров только кладутся в очередь (QueueHandler), в stderr их пишет фоновый поток
+    QueueListener: конкурентные документы не ждут запись в stderr и его блокировку
+    """
+    log_queue: SimpleQueue = SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+
+def _cleanup_on_sigterm(*dirs: str):
+    """По SIGTERM удалить каталоги временных файлов и завершиться (обработчик по умолчанию их бы оставил)"""
+    def handler(signum, frame):
+        for tmp_dir in dirs:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise SystemExit(128 + signum)
+    return signal.signal(signal.SIGTERM, handler)
+
+
+def _download_to_tmp(object_name: str, tmp_dir: Optional[str] = None, size: Optional[int] = None) -> Tuple[str, int]:
+    """
+    Скачать объект из MinIO потоком во временный файл в tmp_dir (целиком в потоке), вернуть путь и размер
+    size - размер из предварительного HEAD запроса (повторный не нужен)
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=Path(object_name).suffix, dir=tmp_dir) as tmp:
+        try:
+            file_size = download_file_to(tmp, object_name, size=size)
+        except Exception:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+        return tmp.name, file_size
+
+
+async def _record_failure(db, document_id, etag: str, error: str):
+    """Записать документ в журнал ошибок (своя транзакция: транзакция документа к этому моменту откачена)"""
+    try:
+        async with db.begin():
+            await db.execute(UPSERT_FAILURE_SQL, {
+                "document_id": document_id,
+                "source_etag": etag,
+                "error": error[:1000]
+            })
+    except Exception as e:
+        logger.error(f"❌ Не удалось записать ошибку документа {document_id}: {e}")
+
+
+async def _process_one(
+    doc: Row,
+    stat: Tuple[str, int],
+    processor: DocumentProcessor,
+    state: Optional[Tuple[str, str, str]],
+    failed_etag: Optional[str],
+    tmp_dirs: Tuple[str, str],
+    near_duplicates: Optional[_NearDuplicateIndex]
+) -> Optional[bool]:
+    """
+    Обработать один документ (Row с id, title, path) в своей сессии (сессии нельзя делить между конкурентными задачами)
+    Блокирующие загрузка из MinIO, работа с файлами и извлечение текста идут в потоках.
+    Записи документа - одна транзакция (async with db.begin()): ошибка откатывает только ее
+    
+    Args:
+        stat: ETag и размер объекта в MinIO
+        state: Сохраненное состояние (source_etag, rag_version, qwen_version) или None
+        failed_etag: ETag, на котором документ ранее завершился ошибкой, или None
+        tmp_dirs: Каталоги временных файлов запуска (для небольших файлов, для остальных)
+        near_duplicates: Индекс почти-дубликатов запуска или None
         
-        for doc in docs:
-            logger.info(f"\n{'='*60}")
-            logger.info(f"🔄 Обрабатываю: {doc.title} (ID: {doc.id})")
-            logger.info(f"{'='*60}")
+    Returns:
+        True - обработан, False - ошибка или нет текста, None - не изменился с прошлой обработки
+    """
+    etag, object_size = stat
+    versions = _pipeline_versions()
+    if not REPROCESS_FORCE:
+        # ETag совпал вместе с версиями - загрузка и обработка не нужны
+        if state == (etag, *versions):
+            logger.info(f"⏭️ {doc.title} не изменился с прошлой обработки, пропускаю")
+            return None
+        # Тот же файл уже завершался ошибкой (REPROCESS_RETRY_FAILED=1 - повторить)
+        if failed_etag == etag and not REPROCESS_RETRY_FAILED:
+            logger.info(f"⏭️ {doc.title} ранее завершился ошибкой (reprocess_failures), пропускаю")
+            return False
+    
+    # Итог документа - одна строка INFO; шаги - на уровне DEBUG
+    started = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        try:
+            logger.debug(f"🔄 Обрабатываю: {doc.title} (ID: {doc.id})")
+            
+            # Загружаем файл из MinIO
+            logger.debug("📥 Загружаю файл из MinIO...")
+            file_ext = Path(doc.path).suffix.lower()
+            tmp_path = None
+            if file_ext in DocumentProcessor.PLAIN_TEXT_EXTENSIONS:
+                # Текстовые форматы - в память: без временного файла и парсеров
+                file_data = await asyncio.to_thread(download_file, doc.path)
+                file_size = len(file_data)
+            else:
+                tmp_dir = tmp_dirs[0] if object_size <= REPROCESS_SHM_MAX_BYTES else tmp_dirs[1]
+                tmp_path, file_size = await asyncio.to_thread(_download_to_tmp, doc.path, tmp_dir, object_size)
+            logger.debug(f"✅ Файл загружен, размер: {file_size} байт")
             
             try:
-                # Загружаем файл из MinIO
-                logger.info("📥 Загружаю файл из MinIO...")
-                file_data = download_file(doc.path)
-                logger.info(f"✅ Файл загружен, размер: {len(file_data)} байт")
-                
                 # Извлекаем текст
-                file_ext = Path(doc.path).suffix
-                with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp:
-                    tmp.write(file_data)
-                    tmp_path = tmp.name
-                
-                try:
-                    logger.info("📝 Извлекаю текст из документа...")
-                    text = processor.load_file(tmp_path)
-                    logger.info(f"✅ Извлечено текста: {len(text)} символов")
-                    
-                    if not text or len(text.strip()) < 10:
-                        logger.warning(f"⚠️ Документ {doc.title} содержит слишком мало текста, пропускаю")
-                        continue
-                    
-                    # Обрабатываем через RAG для получения метрик
-                    logger.info("🔄 Обрабатываю через RAG...")
-                    metrics = await rag_service.process_document_for_metrics(
-                        text=text,
-                        filename=doc.title,
-                        file_size=len(file_data)
-                    )
-                    logger.info(f"✅ RAG обработал: {metrics.get('chunks_count', 0)} чанков")
-                    
-                    # Классифицируем документ через Qwen
-                    logger.info("🤖 Классифицирую документ через Qwen...")
-                    classification = await qwen_service.classify_metrics_from_rag(
-                        text=text[:2000],  # Первые 2000 символов для классификации
-                        filename=doc.title,
-                        metrics=metrics
-                    )
-                    logger.info(f"✅ Классификация: тип={classification.get('type')}, приоритет={classification.get('priority')}")
-                    
-                    # Сохраняем метрики и чанки в Postgres
-                    logger.info("💾 Сохраняю чанки в Postgres...")
-                    await rag_service.save_metrics_to_postgres(
-                        db=db,
-                        document_id=str(doc.id),
-                        metrics=metrics,
-                        classification_result=classification
-                    )
-                    await db.commit()
-                    logger.info(f"✅ Документ {doc.title} успешно обработан и сохранен!")
-                    
-                finally:
-                    # Удаляем временный файл
+                logger.debug("📝 Извлекаю текст из документа...")
+                if tmp_path is None:
+                    text = await asyncio.to_thread(processor.load_text_bytes, file_data, file_ext)
+                    del file_data
+                else:
+                    text = await asyncio.to_thread(processor.load_file, tmp_path)
+                logger.debug(f"✅ Извлечено текста: {len(text)} символов")
+            finally:
+                # Удаляем временный файл сразу (место в /dev/shm нужно следующим документам)
+                if tmp_path is not None:
                     try:
-                        os.unlink(tmp_path)
-                    except:
-                        pass
-                        
-            except Exception as e:
-                logger.error(f"❌ Ошибка при обработке документа {doc.title}: {e}")
-                import traceback
-                traceback.print_exc()
-                await db.rollback()
-                continue
-        
-        logger.info(f"\n{'='*60}")
-        logger.info(f"✅ Обработка завершена!")
-        logger.info(f"{'='*60}")
+                        await asyncio.to_thread(os.unlink, tmp_path)
+                    except OSError as e:
+                        logger.warning(f"⚠️ Не удалось удалить временный файл {tmp_path}: {e}")
+            
+            if not text or len(text.strip()) < 10:
+                logger.warning(f"⚠️ Документ {doc.title} содержит слишком мало текста, пропускаю")
+                await _record_failure(db, doc.id, etag, "Слишком мало текста")
+                return False
+            
+            signature = None
+            if near_duplicates is not None:
+                signature = await asyncio.to_thread(_NearDuplicateIndex.minhash, text)
+            
+            # Обрабатываем через RAG для получения метрик
+            logger.debug("🔄 Обрабатываю через RAG...")
+            metrics = await rag_service.process_document_for_metrics(
+                text=text,
+                filename=doc.title,
+                file_size=file_size
+            )
+            logger.debug(f"✅ RAG обработал: {metrics.get('chunks_count', 0)} чанков")
+            
+            # Полный текст дальше не нужен: классификации хватает начала (промпт Qwen и fallback
+            # смотрят не дальше CLASSIFY_TEXT_CHARS символов). Ссылка на многомегабайтную
+            # строку не держится, пока документ ждет Qwen и запись в Postgres
+            text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            text_chars = len(text)
+            metrics["text"] = text[:CLASSIFY_TEXT_CHARS]
+            del text
+            
+            # Классифицируем документ через Qwen (одинаковый текст - из кэша, без генерации).
+            # Кэш читается короткой транзакцией: соединение не простаивает в транзакции во время генерации
+            async with db.begin():
+                classification = await _get_cached_classification(db, text_hash)
+            similar = None
+            new_classification = classification is None
+            if classification is not None:
+                classification_source = "кэш"
+            elif signature is not None and (similar := near_duplicates.find(signature)) is not None:
+                classification_source = "почти-дубликат"
+                classification = similar
+            else:
+                classification_source = "Qwen"
+                logger.debug("🤖 Классифицирую документ через Qwen...")
+                # Текст и имя файла берутся из метрик (промпт строится по началу текста)
+                classification = await qwen_service.classify_metrics_from_rag(metrics)
+            # Fallback-классификация не кэшируется, не становится представителем почти-дубликатов
+            # и не записывается в processing_state: следующий запуск классифицирует документ заново
+            classified = bool(classification.get("processed"))
+            # Представителем группы становится только документ со своей классификацией
+            if classified and signature is not None and similar is None:
+                near_duplicates.add(text_hash, signature, classification)
+            doc_classification = classification.get("classification", {})
+            
+            # Эмбеддинги чанков считаются до транзакции: пока модель работает, строки документа
+            # не заблокированы и соединение не простаивает в транзакции
+            chunk_embeddings = await rag_service.embed_document_chunks(metrics)
+            
+            # Все записи документа - одна транзакция: commit при успешном выходе из блока, rollback
+            # при исключении. Ее коммит не ждет fsync WAL: при сбое теряются лишь последние коммиты,
+            # а переобработка повторяема
+            logger.debug("💾 Сохраняю чанки в Postgres...")
+            async with db.begin():
+                await db.execute(SYNC_COMMIT_OFF_SQL)
+                if new_classification and classified:
+                    await _save_cached_classification(db, text_hash, classification)
+                if classified:
+                    await db.execute(UPSERT_PROCESSING_STATE_SQL, {
+                        "document_id": doc.id,
+                        "source_etag": etag,
+                        "rag_version": versions[0],
+                        "qwen_version": versions[1]
+                    })
+                else:
+                    await db.execute(DELETE_PROCESSING_STATE_SQL, {"document_id": doc.id})
+                await db.execute(DELETE_FAILURE_SQL, {"document_id": doc.id})
+                # Чанки прошлой обработки заменяются новыми в той же транзакции:
+                # поиск не видит старые и новые чанки документа одновременно
+                await rag_service.delete_document_chunks(db, str(doc.id), commit=False)
+                await rag_service.save_metrics_to_postgres(
+                    db=db,
+                    document_id=str(doc.id),
+                    metrics=metrics,
+                    classification_result=classification,
+                    commit=False,
+                    chunk_embeddings=chunk_embeddings
+                )
+            logger.info(
+                f"✅ {doc.title} (ID: {doc.id}): {file_size} байт, {text_chars} символов, "
+                f"{metrics.get('chunks_count', 0)} чанков, тип={doc_classification.get('type')}, "
+                f"приоритет={doc_classification.get('priority')} ({classification_source}), "
+                f"{(time.perf_counter() - started) * 1000:.0f} мс"
+            )
+            return True
+                    
+        except Exception as e:
+            logger.exception(f"❌ Ошибка при обработке документа {doc.title}: {e}")
+            await _record_failure(db, doc.id, etag, f"{type(e).__name__}: {e}")
+            return False
+
+async def reprocess_documents():
+    """Обработать все документы через RAG (REPROCESS_CONCURRENCY документов одновременно)"""
+    async with engine.begin() as conn:
+        await conn.execute(CREATE_TEXT_CACHE_SQL)
+        await conn.execute(CREATE_PROCESSING_STATE_SQL)
+        await conn.execute(CREATE_FAILURES_SQL)
+        # Состояния всех документов одним запросом
+        states = {
+            document_id: (source_etag, rag_version, qwen_version)
+            for document_id, source_etag, rag_version, qwen_version
+            in await conn.execute(SELECT_PROCESSING_STATES_SQL)
+        }
+        failures = dict((await conn.execute(SELECT_FAILURES_SQL)).all())
+    
+    # Временные файлы запуска лежат в своих каталогах, которые удаляются целиком при выходе
+    # (в том числе по исключению и SIGTERM): прерванный запуск не оставляет файлы в /tmp и /dev/shm
+    with tempfile.TemporaryDirectory(prefix="reprocess-", dir=SHM_DIR) as small_tmp_dir, \
+            tempfile.TemporaryDirectory(prefix="reprocess-") as large_tmp_dir:
+        previous_handler = _cleanup_on_sigterm(small_tmp_dir, large_tmp_dir)
+        try:
+            processed, skipped, total = await _reprocess_all(states, failures, (small_tmp_dir, large_tmp_dir))
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+    
+    logger.info(f"✅ Обработка завершена! Успешно: {processed}/{total}, без изменений: {skipped}")
+
+
+async def _reprocess_all(states: Dict, failures: Dict, tmp_dirs: Tuple[str, str]) -> Tuple[int, int, int]:
+    """Прогнать документы через пул воркеров, вернуть (обработано, без изменений, всего)"""
+    processor = DocumentProcessor()
+    near_duplicates = _build_near_duplicate_index()
+    
+    async with AsyncSessionLocal() as db:
+        # Только используемые столбцы: легкие Row вместо ORM-объектов Document
+        docs = (await db.execute(
+            select(Document.id, Document.title, Document.path)
+            .where(Document.is_deleted == False)
+        )).all()
+    total = len(docs)
+    
+    # HEAD всех объектов заранее и параллельно: ETag для пропуска неизмененных документов и размер
+    # для расписания. Крупные документы идут первыми (LPT): самые долгие не остаются в хвосте,
+    # когда остальные воркеры уже простаивают
+    logger.info(f"📊 Получаю сведения об объектах MinIO: {total} документов...")
+    with ThreadPoolExecutor(max_workers=STAT_WORKERS) as pool:
+        stats = await asyncio.to_thread(lambda: list(pool.map(_stat_or_none, [doc.path for doc in docs])))
+    results: List[Optional[bool]] = [False] * sum(1 for stat in stats if stat is None)
+    schedule = sorted(
+        ((doc, stat) for doc, stat in zip(docs, stats) if stat is not None),
+        key=lambda item: item[1][1],
+        reverse=True
+    )
+    del docs, stats
+    
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in schedule:
+        queue.put_nowait(item)
+    for _ in range(REPROCESS_CONCURRENCY):
+        queue.put_nowait(None)
+    
+    async def worker():
+        # Загрузка, RAG, Qwen и запись в Postgres разных документов перекрываются
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            doc, stat = item
+            results.append(await _process_one(
+                doc, stat, processor, states.get(doc.id), failures.get(doc.id), tmp_dirs, near_duplicates
+            ))
+    
+    await asyncio.gather(*(worker() for _ in range(REPROCESS_CONCURRENCY)))
+    
+    processed = sum(1 for ok in results if ok)
+    skipped = sum(1 for ok in results if ok is None)
+    return processed, skipped, total
 
 if __name__ == "__main__":
-    asyncio.run(reprocess_documents())
+    # uvloop (ставится с uvicorn[standard]) - event loop с меньшими накладными расходами
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    listener = _setup_logging()
+    try:
+        asyncio.run(reprocess_documents())
+    finally:
+        listener.stop()
 